@@ -0,0 +1,10 @@
+import os
+import sys
+
+# The modules are installed to /usr/lib/sticky rather than as a package, so the tests import them from there in the
+# source tree. Only the ones that don't need GTK (markup.py, storage.py and so on) are tested, so that the tests can run
+# without a display.
+STICKY_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'usr', 'lib', 'sticky')
+
+if STICKY_DIR not in sys.path:
+    sys.path.insert(0, STICKY_DIR)
@@ -0,0 +1,169 @@
+#!/usr/bin/python3
+
+# Times reading and writing note markup on generated notes, without GTK or a display:
+#   python3 tests/benchmark_markup.py [--notes N] [--size CHARACTERS] [--repeat N] [--large-size CHARACTERS]
+# Each operation is timed over all of the notes, and the best of the repeats is printed. Loading and searching are
+# timed with the notes in each of the note formats (see markup.NOTE_FORMATS). A single large formatted note
+# is then timed on its own, and if GTK can be loaded, so is reading it back out of a NoteBuffer.
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'usr', 'lib', 'sticky'))
+
+from markup import (OBJECT_REPLACEMENT_CHAR, TAG_NAMES, Markup, get_note_fields, get_note_markup, get_note_plain_text,
+                    parse_markup, serialize_markup)
+from search import SearchIndex
+from storage import add_derived_fields
+
+WORDS = ['note', 'sticky', 'shopping', 'list', 'milk', 'call', 'tomorrow', 'meeting', '#1', 'http://example.com']
+
+def generate_markup(rng, size):
+    # a note of about `size` characters, in lines that are sometimes checklists or bullet lists, with some formatting
+    lines = []
+    anchors = []
+    tags = []
+    length = 0
+    while length < size:
+        line = ''
+        if rng.random() < 0.3:
+            anchors.append((length, rng.choice(['check', 'bullet']), rng.random() < 0.5))
+            line = OBJECT_REPLACEMENT_CHAR + ' '
+
+        line += ' '.join(rng.choice(WORDS) for index in range(rng.randint(2, 12))) + '\n'
+        if rng.random() < 0.3:
+            start = length + rng.randint(0, len(line) - 1)
+            tags.append((rng.choice(TAG_NAMES), start, length + len(line) - 1))
+
+        lines.append(line)
+        length += len(line)
+
+    return Markup(''.join(lines), anchors, tags)
+
+def best_time(func, repeat):
+    times = []
+    for index in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+def index_notes(notes):
+    # what opening the manager does with notes that have just been loaded, which start without the derived fields
+    notes = [dict(note, id=str(number)) for (number, note) in enumerate(notes)]
+    add_derived_fields(notes)
+    index = SearchIndex()
+    index.update_group('notes', notes)
+
+    return index
+
+def search_notes(index):
+    for query in ['milk', 'meeting tomorrow', 'shopping list call', 'mi']:
+        list(index.search(query, ['notes'], 50))
+
+def get_note_buffer_class():
+    # NoteBuffer needs GTK and a display, which the rest of this doesn't
+    try:
+        import gi
+        gi.require_version('Gtk', '3.0')
+        from gi.repository import Gtk
+    except (ImportError, ValueError):
+        return None
+
+    if not Gtk.init_check(None)[0]:
+        return None
+
+    import builtins
+    builtins.__dict__.setdefault('_', lambda text: text)
+    from note_buffer import NoteBuffer
+
+    return NoteBuffer
+
+def benchmark_large_note(markup, repeat):
+    text = serialize_markup(markup, TAG_NAMES)
+    operations = [
+        ('serialize markup', lambda: serialize_markup(markup, TAG_NAMES)),
+        ('parse markup', lambda: parse_markup(text)),
+    ]
+
+    note_buffer_class = get_note_buffer_class()
+    if note_buffer_class is not None:
+        buffer = note_buffer_class()
+        buffer.set_from_markup(markup)
+        middle_line = buffer.get_line_count() // 2
+
+        def read_all():
+            buffer.read_markup(buffer.get_start_iter(), buffer.get_end_iter())
+
+        def serialize_all():
+            # with nothing cached, every line is read and serialized
+            buffer.line_cache = None
+            buffer.get_internal_markup()
+
+        def serialize_after_edit():
+            # what saving after typing a character does: only the changed line is read again
+            buffer.insert(buffer.get_iter_at_line(middle_line), 'x')
+            buffer.get_internal_markup()
+
+        buffer.get_internal_markup()
+        operations += [
+            ('buffer read_markup', read_all),
+            ('buffer serialize', serialize_all),
+            ('buffer after edit', serialize_after_edit),
+        ]
+
+    print('one note of %d characters with %d tags and %d anchors, best of %d' %
+          (len(markup.text), len(markup.tags), len(markup.anchors), repeat))
+    for (name, func) in operations:
+        print('%-20s %9.2f ms' % (name, best_time(func, repeat) * 1000))
+
+    if note_buffer_class is None:
+        print('(GTK could not be loaded, so NoteBuffer was not timed)')
+
+def main():
+    parser = argparse.ArgumentParser(description='Time reading and writing note markup')
+    parser.add_argument('--notes', type=int, default=2000, help='how many notes to generate')
+    parser.add_argument('--size', type=int, default=1000, help='roughly how many characters each note has')
+    parser.add_argument('--repeat', type=int, default=5, help='how many times to time each operation')
+    parser.add_argument('--large-size', type=int, default=100000, help='roughly how many characters the large note has')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    markups = [generate_markup(rng, args.size) for index in range(args.notes)]
+    markup_notes = [get_note_fields(markup, 'markup') for markup in markups]
+    spans_notes = [get_note_fields(markup, 'spans') for markup in markups]
+
+    operations = [
+        ('serialize markup', lambda: [serialize_markup(markup, TAG_NAMES) for markup in markups]),
+        ('parse markup', lambda: [parse_markup(note['text']) for note in markup_notes]),
+        ('load markup note', lambda: [get_note_markup(note) for note in markup_notes]),
+        ('load spans note', lambda: [get_note_markup(note) for note in spans_notes]),
+        ('plain text (markup)', lambda: [get_note_plain_text(note) for note in markup_notes]),
+        ('plain text (spans)', lambda: [get_note_plain_text(note) for note in spans_notes]),
+        ('convert to spans', lambda: [get_note_fields(get_note_markup(note), 'spans') for note in markup_notes]),
+        ('index markup notes', lambda: index_notes(markup_notes)),
+        ('index spans notes', lambda: index_notes(spans_notes)),
+    ]
+
+    # the index only has the plain text, so searching should take the same time with either format
+    markup_index = index_notes(markup_notes)
+    spans_index = index_notes(spans_notes)
+    operations += [
+        ('search markup notes', lambda: search_notes(markup_index)),
+        ('search spans notes', lambda: search_notes(spans_index)),
+    ]
+
+    print('%d notes of about %d characters, best of %d' % (args.notes, args.size, args.repeat))
+    for (name, func) in operations:
+        seconds = best_time(func, args.repeat)
+        print('%-20s %9.2f ms  %7.1f us/note' % (name, seconds * 1000, seconds * 1000000 / args.notes))
+
+    print()
+    benchmark_large_note(generate_markup(rng, args.large_size), args.repeat)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+
+# Times saving and loading notes with each way of storing them, for a few sizes of note collection, without GTK or a
+# display:
+#   python3 tests/benchmark_storage.py [--sizes 100,10000,100000] [--edits N] [--fsync-policy none|file|full]
+# "edit" is how long saving one changed note takes, which is what happens every few seconds while a note is being
+# edited, and shouldn't depend on how many other notes there are.
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'usr', 'lib', 'sticky'))
+
+from storage import ShardedStore, SqliteStore, read_notes_lists, write_file_atomic
+
+# how many notes go in each group
+GROUP_SIZE = 100
+
+# All of the notes in a single notes.json, written in full on every save, as older versions did
+class SingleFileStore(object):
+    def __init__(self, directory):
+        self.path = os.path.join(directory, 'notes.json')
+        self.notes_lists = {}
+
+    def save(self, changed_groups, group_names, fsync_policy='full'):
+        notes_lists = {group_name: changed_groups.get(group_name, self.notes_lists.get(group_name))
+                       for group_name in group_names}
+        write_file_atomic(self.path, lambda file: json.dump(notes_lists, file), fsync_policy)
+        self.notes_lists = notes_lists
+
+    def load(self):
+        with open(self.path, 'r') as file:
+            self.notes_lists = read_notes_lists(file)
+
+        return self.notes_lists
+
+STORES = [
+    ('notes.json', SingleFileStore),
+    ('files', ShardedStore),
+    ('sqlite', SqliteStore),
+]
+
+def generate_notes(rng, count):
+    notes_lists = {}
+    for index in range(count):
+        group_name = 'group %d' % (index // GROUP_SIZE)
+        text = ' '.join(rng.choice(['note', 'sticky', 'milk', 'call', 'tomorrow']) for word in range(50))
+        notes_lists.setdefault(group_name, []).append({
+            'id': 'note %d' % index, 'title': 'Note %d' % index, 'text': text, 'color': 'yellow',
+            'x': 10, 'y': 10, 'width': 200, 'height': 200
+        })
+
+    return notes_lists
+
+def benchmark(store_class, notes_lists, edits, fsync_policy):
+    # returns the time taken by the first save (of everything), the average time to save an edit, and to load
+    rng = random.Random(0)
+    group_names = list(notes_lists.keys())
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = store_class(directory)
+
+        start = time.perf_counter()
+        store.save({group_name: [note.copy() for note in notes] for group_name, notes in notes_lists.items()},
+                   group_names, fsync_policy)
+        first_save = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for index in range(edits):
+            group_name = rng.choice(group_names)
+            notes = [note.copy() for note in notes_lists[group_name]]
+            note_index = rng.randrange(len(notes))
+            notes[note_index]['text'] += ' edited %d' % index
+            store.save({group_name: notes}, group_names, fsync_policy)
+        edit = (time.perf_counter() - start) / edits
+
+        start = time.perf_counter()
+        store_class(directory).load()
+        load = time.perf_counter() - start
+
+    return (first_save, edit, load)
+
+def main():
+    parser = argparse.ArgumentParser(description='Time saving and loading notes with each storage backend')
+    parser.add_argument('--sizes', default='100,10000,100000', help='how many notes to time, separated by commas')
+    parser.add_argument('--edits', type=int, default=20, help='how many edits to save for each size')
+    parser.add_argument('--fsync-policy', default='none', choices=['none', 'file', 'full'])
+    args = parser.parse_args()
+
+    print('%-12s %8s %12s %12s %12s' % ('store', 'notes', 'first save', 'edit', 'load'))
+    for size in [int(size) for size in args.sizes.split(',')]:
+        notes_lists = generate_notes(random.Random(size), size)
+        for (name, store_class) in STORES:
+            (first_save, edit, load) = benchmark(store_class, notes_lists, args.edits, args.fsync_policy)
+            print('%-12s %8d %9.2f ms %9.2f ms %9.2f ms' % (name, size, first_save * 1000, edit * 1000, load * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+
+import contextlib
+import io
+import random
+import unittest
+
+from markup import (OBJECT_REPLACEMENT_CHAR, TAG_NAMES, Markup, get_note_fields, get_note_markup, get_note_plain_text,
+                    get_plain_text, join_markup, parse_markup, serialize_markup, serialize_markup_part)
+
+# how many random notes each of the round-trip tests checks
+RANDOM_NOTES = 500
+
+# characters the random text is made of, with plenty of the ones that mean something in the markup
+TEXT_CHARACTERS = 'ab #:\né'
+TEXT_PIECES = ['##', '#tag:bold:', '#check:1', '#bullet:', 'tag', 'check']
+
+def random_markup(rng):
+    # A random Markup with checkboxes, bullets and (possibly overlapping) tags, including a tag that NoteBuffer doesn't
+    # have, which serialize_markup() still has to cope with.
+    pieces = []
+    anchors = []
+    length = 0
+    for index in range(rng.randint(0, 30)):
+        choice = rng.random()
+        if choice < 0.1:
+            anchor_type = rng.choice(['check', 'bullet'])
+            anchors.append((length, anchor_type, anchor_type == 'check' and rng.random() < 0.5))
+            piece = OBJECT_REPLACEMENT_CHAR
+        elif choice < 0.3:
+            piece = rng.choice(TEXT_PIECES)
+        else:
+            piece = ''.join(rng.choice(TEXT_CHARACTERS) for index in range(rng.randint(1, 8)))
+
+        pieces.append(piece)
+        length += len(piece)
+
+    tags = []
+    for index in range(rng.randint(0, 6)):
+        start = rng.randint(0, length)
+        end = rng.randint(start, length)
+        tags.append((rng.choice(TAG_NAMES + ['unknown']), start, end))
+
+    return Markup(''.join(pieces), anchors, tags)
+
+def get_tagged_offsets(markup):
+    # tag name -> the offsets it applies to, which is what matters about the tags, however they're split into spans
+    offsets = {}
+    for (tag_name, start, end) in markup.tags:
+        if start < end:
+            offsets.setdefault(tag_name, set()).update(range(start, end))
+
+    return offsets
+
+def split_markup(markup, offset):
+    # splits `markup` in two at `offset`, the way NoteBuffer splits a buffer into lines
+    before = Markup(markup.text[:offset],
+                    [anchor for anchor in markup.anchors if anchor[0] < offset],
+                    [(tag_name, start, min(end, offset)) for (tag_name, start, end) in markup.tags if start < offset])
+    after = Markup(markup.text[offset:],
+                   [(anchor_offset - offset, anchor_type, checked) for (anchor_offset, anchor_type, checked)
+                    in markup.anchors if anchor_offset >= offset],
+                   [(tag_name, max(start, offset) - offset, end - offset) for (tag_name, start, end) in markup.tags
+                    if end > offset])
+
+    return (before, after)
+
+class RoundTripTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(1234)
+
+    def assertSameMarkup(self, first, second):
+        self.assertEqual(first.text, second.text)
+        self.assertEqual(first.anchors, second.anchors)
+        self.assertEqual(get_tagged_offsets(first), get_tagged_offsets(second))
+
+    def test_parse_serialize(self):
+        for index in range(RANDOM_NOTES):
+            markup = random_markup(self.rng)
+            text = serialize_markup(markup, TAG_NAMES)
+            parsed = parse_markup(text)
+
+            self.assertSameMarkup(parsed, markup)
+            self.assertEqual(serialize_markup(parsed, TAG_NAMES), text)
+
+    def test_spans_format(self):
+        for index in range(RANDOM_NOTES):
+            markup = random_markup(self.rng)
+            note = get_note_fields(markup, 'spans')
+
+            self.assertSameMarkup(get_note_markup(note), markup)
+            self.assertEqual(get_note_fields(get_note_markup(note), 'markup'), get_note_fields(markup, 'markup'))
+
+    def test_markup_to_spans_and_back(self):
+        # overlapping tags, a tag that starts on an anchor and one that ends on one, and a literal '#'
+        text = '#check:1#tag:bold:a #tag:italic:b## #bullet:c#tag:bold:d#tag:italic: #check:0e#tag:underline:f#bullet:'
+        text += '#tag:underline:'
+        note = get_note_fields(parse_markup(text), 'spans')
+
+        self.assertEqual(note['text'], '￼a b# ￼cd ￼ef￼')
+        self.assertEqual(note['anchors'], [[0, 'check', True], [6, 'bullet', False], [10, 'check', False],
+                                           [13, 'bullet', False]])
+        self.assertEqual(sorted(note['spans']), [[1, 8, 'bold'], [3, 9, 'italic'], [12, 14, 'underline']])
+        self.assertEqual(get_note_fields(get_note_markup(note), 'markup'), {'text': text})
+
+    def test_markup_format(self):
+        for index in range(RANDOM_NOTES):
+            markup = random_markup(self.rng)
+            note = get_note_fields(markup, 'markup')
+
+            self.assertNotIn('format', note)
+            self.assertSameMarkup(get_note_markup(note), markup)
+
+    def test_serialize_in_parts(self):
+        # serializing a text a part at a time, as the per-line cache does, has to give the same markup
+        for index in range(RANDOM_NOTES):
+            markup = random_markup(self.rng)
+            (before, after) = split_markup(markup, self.rng.randint(0, len(markup.text)))
+
+            on_tags = []
+            off_tags = list(TAG_NAMES)
+            text = serialize_markup_part(before, on_tags, off_tags)
+            text += serialize_markup_part(after, on_tags, off_tags)
+            text += ['#tag:%s:' % tag_name for tag_name in on_tags]
+
+            self.assertEqual(''.join(text), serialize_markup(markup, TAG_NAMES))
+            self.assertSameMarkup(join_markup([before, after]), markup)
+
+    def test_known_markup(self):
+        text = 'a ## b #check:1x#check:0 #bullet:#tag:bold:bold#tag:italic: both#tag:bold: italic#tag:italic:'
+        markup = parse_markup(text)
+
+        self.assertEqual(markup.text, 'a # b ￼x￼ ￼bold both italic')
+        self.assertEqual(markup.anchors, [(6, 'check', True), (8, 'check', False), (10, 'bullet', False)])
+        self.assertEqual(sorted(markup.tags), [('bold', 11, 20), ('italic', 15, 27)])
+        self.assertEqual(serialize_markup(markup, TAG_NAMES), text)
+
+    def test_unclosed_tag(self):
+        # tags that are never closed have always been dropped when loading
+        markup = parse_markup('#tag:bold:text')
+
+        self.assertEqual(markup.text, 'text')
+        self.assertEqual(markup.tags, [])
+
+    def test_stray_hash(self):
+        # a '#' that isn't part of any markup is kept as text
+        with contextlib.redirect_stdout(io.StringIO()):
+            markup = parse_markup('a #b')
+
+        self.assertEqual(markup.text, 'a #b')
+
+class PlainTextTest(unittest.TestCase):
+    def test_known_markup(self):
+        text = 'a ## b #check:1x#check:0 #bullet:#tag:bold:bold#tag:bold: #tag:link:http://x#tag:link:'
+        self.assertEqual(get_plain_text(text), 'a # b x bold http://x')
+
+    def test_empty(self):
+        self.assertEqual(get_plain_text(''), '')
+        self.assertEqual(get_note_plain_text({}), '')
+
+    def test_random_markup(self):
+        # get_plain_text() gives the same as parsing the markup and dropping the anchors, in either note format
+        rng = random.Random(5678)
+        for index in range(RANDOM_NOTES):
+            markup = random_markup(rng)
+            plain_text = ''.join(markup.split_anchors())
+
+            self.assertEqual(get_plain_text(serialize_markup(markup, TAG_NAMES)), plain_text)
+            self.assertEqual(get_note_plain_text(get_note_fields(markup, 'markup')), plain_text)
+            self.assertEqual(get_note_plain_text(get_note_fields(markup, 'spans')), plain_text)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,232 @@
+#!/usr/bin/python3
+
+import math
+import random
+import unittest
+
+from search import (BM25_B, BM25_K1, FUZZY_MIN_LENGTH, FUZZY_THRESHOLD, TITLE_WEIGHT, SearchIndex, get_trigrams,
+                    normalize, tokenize)
+
+# words the random notes are made of, with shared prefixes and near misses so that prefix and fuzzy matches overlap
+WORDS = ['meeting', 'meet', 'meetings', 'workshop', 'shop', 'shopping', 'café', 'cafe', 'call', 'calls', 'milk',
+         'tomorrow', 'tomorow', 'notes', 'note', 'list']
+
+def make_note(note_id, title='', text=''):
+    return {'id': note_id, 'title': title, 'text': text}
+
+def random_note(rng, note_id):
+    note = make_note(note_id, ' '.join(rng.choice(WORDS) for index in range(rng.randint(0, 2))),
+                     ' '.join(rng.choice(WORDS) for index in range(rng.randint(0, 8))))
+    if rng.random() < 0.5:
+        # the file handler adds these (see storage.add_derived_fields())
+        note['plain_text'] = note['text'].lower()
+        note['normalized_title'] = normalize(note['title'])
+
+    return note
+
+def random_query(rng):
+    words = []
+    for index in range(rng.randint(1, 3)):
+        word = rng.choice(WORDS)
+        choice = rng.random()
+        if choice < 0.3:
+            # still being typed
+            word = word[:rng.randint(1, len(word))]
+        elif choice < 0.5:
+            # a typo
+            position = rng.randrange(len(word))
+            word = word[:position] + rng.choice('aeiouxz') + word[position + 1:]
+        words.append(word)
+
+    return ' '.join(words)
+
+# The notes as the index should see them: group name -> notes, in order. A note that is added to a group leaves the one
+# it was in, the way dragging a note to another group does.
+class IndexModel(object):
+    def __init__(self):
+        self.groups = {}
+
+    def update_group(self, group_name, notes):
+        ids = {note['id'] for note in notes}
+        for (other_name, other_notes) in self.groups.items():
+            if other_name != group_name:
+                other_notes[:] = [note for note in other_notes if note['id'] not in ids]
+        self.groups[group_name] = list(notes)
+
+    def remove_group(self, group_name):
+        self.groups.pop(group_name, None)
+
+    def rename_group(self, old_name, new_name):
+        self.groups.pop(new_name, None)
+        self.groups[new_name] = self.groups.pop(old_name, [])
+
+    def get_counts(self, note):
+        # token -> weighted count, worked out the slow way
+        counts = {}
+        for token in tokenize(note['text']):
+            counts[token] = counts.get(token, 0) + 1
+        for token in tokenize(note['title']):
+            counts[token] = counts.get(token, 0) + TITLE_WEIGHT
+
+        return counts
+
+    def get_weights(self, word, all_counts):
+        # token -> weight for `word`, going through every token of every note
+        document_counts = {}
+        for counts in all_counts.values():
+            for token in counts:
+                document_counts[token] = document_counts.get(token, 0) + 1
+
+        trigrams = get_trigrams(word)
+        weights = {}
+        for (token, count) in document_counts.items():
+            if token.startswith(word):
+                similarity = 1.0
+            elif len(word) >= FUZZY_MIN_LENGTH:
+                shared = len(trigrams & get_trigrams(token))
+                if shared < FUZZY_THRESHOLD * len(trigrams):
+                    continue
+                similarity = shared / len(trigrams)
+            else:
+                continue
+
+            idf = math.log(1 + (len(all_counts) - count + 0.5) / (count + 0.5))
+            weights[token] = similarity * idf
+
+        return weights
+
+class RandomSearchTest(unittest.TestCase):
+    def assertSearchMatches(self, index, model, query, group_names, limit):
+        # Checks index.search() against scoring every note in `model` one by one
+        all_counts = {note['id']: model.get_counts(note) for notes in model.groups.values() for note in notes}
+        total_length = sum(sum(counts.values()) for counts in all_counts.values())
+        average_length = total_length / max(len(all_counts), 1)
+
+        word_weights = []
+        for word in dict.fromkeys(tokenize(query)):
+            weights = model.get_weights(word, all_counts)
+            # the weights have to be exactly the same, and then which of two tokens with the same weight a note is
+            # scored on is up to the index
+            self.assertEqual(weights, index.get_weights(word))
+            word_weights.append((word, index.get_weights(word)))
+
+        scores = []
+        for group_name in group_names:
+            for note in model.groups.get(group_name, []):
+                counts = all_counts[note['id']]
+                total = 0
+                for (word, weights) in word_weights:
+                    tokens = [token for token in sorted(weights, key=weights.get, reverse=True) if token in counts]
+                    if len(tokens) == 0:
+                        break
+
+                    if len(word) >= FUZZY_MIN_LENGTH:
+                        count = counts[tokens[0]]
+                        length = sum(counts.values())
+                        total += (weights[tokens[0]] * (BM25_K1 + 1) * count /
+                                  (count + BM25_K1 * (1 - BM25_B) + BM25_K1 * BM25_B / average_length * length))
+                    else:
+                        total += weights[tokens[0]]
+                else:
+                    if len(word_weights) > 0:
+                        scores.append((total, group_name, note['id']))
+
+        # sorted() is stable, so the ones with the same score stay in the order of the groups
+        expected = [(group_name, note_id) for (total, group_name, note_id)
+                    in sorted(scores, key=lambda item: item[0], reverse=True)][:limit]
+        results = [(group_name, note['id']) for (group_name, note) in index.search(query, group_names, limit)]
+        self.assertEqual(results, expected, query)
+
+        # the same again with the scores for all but the last word worked out first, as the manager does
+        words = tokenize(query)[:-1]
+        if len(words) > 0:
+            known = (words, index.score_words(words))
+            results = [(group_name, note['id']) for (group_name, note)
+                       in index.search(query, group_names, limit, known)]
+            self.assertEqual(results, expected, query)
+
+    def test_random_changes(self):
+        for seed in range(5):
+            rng = random.Random(seed)
+            index = SearchIndex()
+            model = IndexModel()
+            next_id = 0
+
+            for step in range(150):
+                group_names = list(model.groups)
+                choice = rng.random()
+                if choice < 0.4 or len(group_names) == 0:
+                    # add notes, edit some and drop others
+                    group_name = 'group %d' % rng.randrange(6)
+                    notes = [note if rng.random() < 0.8 else random_note(rng, note['id'])
+                             for note in model.groups.get(group_name, []) if rng.random() < 0.9]
+                    for count in range(rng.randint(0, 5)):
+                        notes.insert(rng.randint(0, len(notes)), random_note(rng, 'note %d' % next_id))
+                        next_id += 1
+                    if rng.random() < 0.2:
+                        rng.shuffle(notes)
+                elif choice < 0.6 and len(group_names) > 1:
+                    # move a note to another group, which is updated first and the old group only later, if at all
+                    (old_name, group_name) = rng.sample(group_names, 2)
+                    if len(model.groups[old_name]) == 0:
+                        continue
+                    note = rng.choice(model.groups[old_name])
+                    notes = list(model.groups[group_name])
+                    notes.insert(rng.randint(0, len(notes)), note)
+                    if rng.random() < 0.5:
+                        index.update_group(group_name, notes)
+                        model.update_group(group_name, notes)
+                        group_name = old_name
+                        notes = list(model.groups[old_name])
+                elif choice < 0.7:
+                    group_name = rng.choice(group_names)
+                    index.remove_group(group_name)
+                    model.remove_group(group_name)
+                    group_name = None
+                elif choice < 0.8:
+                    # renaming onto an existing group replaces it
+                    old_name = rng.choice(group_names)
+                    new_name = 'group %d' % rng.randrange(8)
+                    if new_name != old_name:
+                        index.rename_group(old_name, new_name)
+                        model.rename_group(old_name, new_name)
+                    group_name = None
+                else:
+                    # just search
+                    group_name = None
+
+                if group_name is not None:
+                    index.update_group(group_name, notes)
+                    model.update_group(group_name, notes)
+
+                search_names = list(model.groups) + ['missing']
+                rng.shuffle(search_names)
+                if rng.random() < 0.3:
+                    search_names = search_names[:rng.randint(0, len(search_names))]
+                self.assertSearchMatches(index, model, random_query(rng), search_names,
+                                         rng.choice([None, 1, 3, 10]))
+
+class KnownScoresTest(unittest.TestCase):
+    def test_removed_notes(self):
+        # the scores for the first words of a query are kept from one keystroke to the next, and the notes they're for
+        # can be removed in between
+        index = SearchIndex()
+        index.update_group('group', [make_note(str(number), text='meeting notes %d' % number) for number in range(5)])
+        words = ['meeting']
+        known = (words, index.score_words(words))
+
+        # with few matches among a lot of notes, rank() goes through the matches rather than through every note
+        others = [make_note('other %d' % number, text='shopping list') for number in range(50)]
+        index.update_group('group', [make_note('0', text='meeting notes 0')] + others)
+
+        for limit in [None, 1]:
+            results = list(index.search('meeting notes', ['group'], limit, known))
+            self.assertEqual([note['id'] for (group_name, note) in results], ['0'])
+            results = list(index.search('meeting', ['group'], limit, known))
+            self.assertEqual([note['id'] for (group_name, note) in results], ['0'])
+
+        index.remove_group('group')
+        self.assertEqual(list(index.search('meeting notes', ['group'], None, known)), [])
+
+if __name__ == '__main__':
+    unittest.main()
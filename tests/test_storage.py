@@ -0,0 +1,412 @@
+#!/usr/bin/python3
+
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import unittest
+import unittest.mock
+
+from tests import STICKY_DIR
+from storage import (BackupStore, ShardedStore, SqliteStore, read_notes_lists, remove_stale_temp_files, temp_file_name,
+                     write_file_atomic)
+
+# Writes the file given on the command line with write_file_atomic(), printing 'writing' once part of the new contents
+# has been written and then waiting there to be killed
+STALLED_WRITER = '''
+import sys
+import time
+
+sys.path.insert(0, sys.argv[1])
+from storage import write_file_atomic
+
+def write(file):
+    file.write('{"new": "' + 'x' * 100000)
+    file.flush()
+    print('writing', flush=True)
+    time.sleep(60)
+    file.write('"}')
+
+write_file_atomic(sys.argv[2], write)
+'''
+
+# Saves the file given on the command line over and over, with different contents each time, until it's killed
+BUSY_WRITER = '''
+import json
+import sys
+
+sys.path.insert(0, sys.argv[1])
+from storage import write_file_atomic
+
+print('started', flush=True)
+count = 0
+while True:
+    count += 1
+    data = json.dumps({'count': count, 'padding': 'x' * (count % 50000)})
+    write_file_atomic(sys.argv[2], lambda file: file.write(data), 'none')
+'''
+
+class WriteFileAtomicTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'notes.json')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def read(self):
+        with open(self.path, 'r') as file:
+            return file.read()
+
+    def start_writer(self, script):
+        process = subprocess.Popen([sys.executable, '-c', script, STICKY_DIR, self.path], stdout=subprocess.PIPE,
+                                   universal_newlines=True)
+        self.addCleanup(process.wait)
+        self.addCleanup(process.kill)
+        self.addCleanup(process.stdout.close)
+
+        return process
+
+    def test_write(self):
+        write_file_atomic(self.path, lambda file: file.write('old'))
+        write_file_atomic(self.path, lambda file: file.write('new'))
+
+        self.assertEqual(self.read(), 'new')
+        self.assertEqual(os.listdir(self.directory.name), ['notes.json'])
+
+    def test_write_error(self):
+        # an exception in the middle of writing leaves the old contents, and no temporary file
+        write_file_atomic(self.path, lambda file: file.write('old'))
+
+        def write(file):
+            file.write('new')
+            raise OSError('no space left')
+
+        with self.assertRaises(OSError):
+            write_file_atomic(self.path, write)
+
+        self.assertEqual(self.read(), 'old')
+        self.assertEqual(os.listdir(self.directory.name), ['notes.json'])
+
+    def test_killed_while_writing(self):
+        write_file_atomic(self.path, lambda file: file.write('{"old": true}'))
+
+        process = self.start_writer(STALLED_WRITER)
+        self.assertEqual(process.stdout.readline(), 'writing\n')
+        process.kill()
+        process.wait()
+
+        self.assertEqual(json.loads(self.read()), {'old': True})
+
+        # all that's left of the new contents is the temporary file, which is removed at startup
+        temp_files = [file for file in os.listdir(self.directory.name) if file != 'notes.json']
+        self.assertEqual(len(temp_files), 1)
+        self.assertTrue(temp_file_name.search(temp_files[0]))
+
+        remove_stale_temp_files(self.directory.name)
+        self.assertEqual(os.listdir(self.directory.name), ['notes.json'])
+
+    def test_killed_at_random(self):
+        # however far through a save the writer is when it's killed, the file has to be one whole save or another
+        rng = random.Random(0)
+        for index in range(10):
+            process = self.start_writer(BUSY_WRITER)
+            self.assertEqual(process.stdout.readline(), 'started\n')
+            time.sleep(rng.uniform(0.01, 0.1))
+            process.kill()
+            process.wait()
+
+            if os.path.exists(self.path):
+                data = json.loads(self.read())
+                self.assertEqual(data['padding'], 'x' * (data['count'] % 50000))
+
+class ReadNotesListsTest(unittest.TestCase):
+    def test_read(self):
+        notes_lists = {'group': [{'id': 'a', 'text': 'one'}, {'id': 'b', 'text': 'two'}], 'empty': []}
+        self.assertEqual(read_notes_lists(io.StringIO(json.dumps(notes_lists))), notes_lists)
+
+    def test_invalid(self):
+        for data in ['[]', '{"group": [1]}', '{"group": [{"text": 5}]}', '{"group": []} x', '{"group": [{}]']:
+            with self.assertRaises(ValueError):
+                read_notes_lists(io.StringIO(data))
+
+    def test_peak_memory(self):
+        # Reading a file shouldn't take much more memory than the notes that are read from it. Reading it all in one
+        # go (with json.loads(file.read())) would need at least as much again as the size of the file.
+        notes_lists = {}
+        for group in range(5):
+            notes_lists['group %d' % group] = [{'id': '%d-%d' % (group, index), 'text': 'some text ' * 60,
+                                                'color': 'yellow', 'x': 10, 'y': 10, 'width': 200, 'height': 200}
+                                               for index in range(2000)]
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'notes.json')
+            with open(path, 'w') as file:
+                json.dump(notes_lists, file)
+            size = os.path.getsize(path)
+            del notes_lists
+
+            tracemalloc.start()
+            try:
+                with open(path, 'r') as file:
+                    notes_lists = read_notes_lists(file)
+                (current, peak) = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+
+        self.assertEqual(sum(len(notes) for notes in notes_lists.values()), 10000)
+        self.assertGreater(size, 5 * 1024 * 1024)
+        self.assertLess(peak - current, 1024 * 1024)
+
+class RandomNotes(object):
+    # Makes random changes to some notes in the way FileHandler does, and keeps track of what the store should have in
+    # it: {group name: [notes]}, with note ids that are unique across the groups.
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+        self.notes_lists = {}
+        self.next_id = 0
+
+    def new_note(self):
+        self.next_id += 1
+        return {'id': 'note %d' % self.next_id, 'text': self.random_text(), 'color': 'yellow'}
+
+    def random_text(self):
+        return ''.join(self.rng.choice('ab #\n') for index in range(self.rng.randint(0, 40)))
+
+    def change(self):
+        # makes a random change, and returns the names of the groups that changed
+        groups = list(self.notes_lists.keys())
+        choice = self.rng.random()
+        if len(groups) == 0 or choice < 0.05:
+            group_name = 'group %d' % self.rng.randint(0, 1000)
+            self.notes_lists[group_name] = [self.new_note() for index in range(self.rng.randint(0, 5))]
+            return [group_name]
+
+        group_name = self.rng.choice(groups)
+        notes = self.notes_lists[group_name]
+        if choice < 0.1:
+            del self.notes_lists[group_name]
+            return []
+        elif choice < 0.15:
+            # renaming a group moves it to the end, as FileHandler does
+            new_name = 'group %d' % self.rng.randint(0, 1000)
+            if new_name not in self.notes_lists:
+                self.notes_lists[new_name] = self.notes_lists.pop(group_name)
+                return [new_name]
+        elif choice < 0.2:
+            reordered = dict(self.notes_lists)
+            self.notes_lists = {name: reordered[name] for name in self.rng.sample(groups, len(groups))}
+            return []
+        elif choice < 0.4 or len(notes) == 0:
+            notes.insert(self.rng.randint(0, len(notes)), self.new_note())
+        elif choice < 0.5:
+            notes.pop(self.rng.randrange(len(notes)))
+        elif choice < 0.6:
+            other_group = self.rng.choice(groups)
+            note = notes.pop(self.rng.randrange(len(notes)))
+            other_notes = self.notes_lists[other_group]
+            other_notes.insert(self.rng.randint(0, len(other_notes)), note)
+            return list(set([group_name, other_group]))
+        elif choice < 0.7:
+            self.rng.shuffle(notes)
+        else:
+            index = self.rng.randrange(len(notes))
+            notes[index] = dict(notes[index], text=self.random_text())
+
+        return [group_name]
+
+    def copy(self, group_names):
+        # the stores keep the notes they're given, so like FileHandler, we give them copies
+        return {group_name: [note.copy() for note in self.notes_lists[group_name]] for group_name in group_names}
+
+# Tests for the storage backends, which are all given the same changes and have to give back the same notes
+class StoreTests(object):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = self.create_store()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def create_store(self):
+        raise NotImplementedError
+
+    def assertStoreHas(self, store, notes_lists):
+        # the order of the groups matters, which comparing the dicts wouldn't check
+        self.assertEqual(list(store.load().items()), list(notes_lists.items()))
+
+    def test_save_and_load(self):
+        self.store.save({'a': [{'id': '1', 'text': 'one'}], 'b': []}, ['a', 'b'])
+        self.store.save({'a': [{'id': '1', 'text': 'changed'}, {'id': '2', 'text': 'two'}]}, ['b', 'a'])
+
+        self.assertStoreHas(self.create_store(),
+                            {'b': [], 'a': [{'id': '1', 'text': 'changed'}, {'id': '2', 'text': 'two'}]})
+
+    def test_rename_group(self):
+        self.store.save({'a': [{'id': '1', 'text': 'one'}], 'b': [{'id': '2', 'text': 'two'}]}, ['a', 'b'])
+        self.store.save({'c': [{'id': '1', 'text': 'one'}]}, ['b', 'c'])
+
+        self.assertStoreHas(self.create_store(), {'b': [{'id': '2', 'text': 'two'}], 'c': [{'id': '1', 'text': 'one'}]})
+
+    def test_remove_group(self):
+        self.store.save({'a': [{'id': '1', 'text': 'one'}], 'b': [{'id': '2', 'text': 'two'}]}, ['a', 'b'])
+        self.store.save({}, ['b'])
+        # a group that comes back after being removed starts from scratch
+        self.store.save({'a': [{'id': '3', 'text': 'three'}]}, ['b', 'a'])
+
+        self.assertStoreHas(self.create_store(),
+                            {'b': [{'id': '2', 'text': 'two'}], 'a': [{'id': '3', 'text': 'three'}]})
+
+    def test_load_group_twice(self):
+        # backups read the groups that haven't been loaded yet, which may then be loaded again
+        self.store.save({'a': [{'id': '1', 'text': 'one'}]}, ['a'])
+        self.store.save({'a': [{'id': '1', 'text': 'one, edited'}, {'id': '2', 'text': 'two'}]}, ['a'])
+
+        store = self.create_store()
+        store.load_index()
+        expected = [{'id': '1', 'text': 'one, edited'}, {'id': '2', 'text': 'two'}]
+        self.assertEqual(store.load_group('a'), expected)
+        self.assertEqual(store.load_group('a'), expected)
+
+    def test_random_changes(self):
+        # After every save, the store has to have the same notes as we do, whether it's read from scratch, or was opened
+        # again part way through with only its index loaded (as with lazy loading)
+        for seed in range(5):
+            self.directory.cleanup()
+            self.directory = tempfile.TemporaryDirectory()
+            self.store = self.create_store()
+            notes = RandomNotes(seed)
+
+            for step in range(200):
+                changed_groups = notes.change()
+                self.store.save(notes.copy(changed_groups), list(notes.notes_lists.keys()), 'none')
+
+                if notes.rng.random() < 0.2:
+                    self.assertStoreHas(self.create_store(), notes.notes_lists)
+
+                if notes.rng.random() < 0.05:
+                    self.store = self.create_store()
+                    self.assertEqual(self.store.load_index(), list(notes.notes_lists.keys()))
+
+            self.assertStoreHas(self.create_store(), notes.notes_lists)
+
+class ShardedStoreTest(StoreTests, unittest.TestCase):
+    def create_store(self):
+        return ShardedStore(self.directory.name)
+
+    def test_random_changes_with_compaction(self):
+        # with a small journal, most saves end up compacting it
+        with unittest.mock.patch('storage.JOURNAL_COMPACT_SIZE', 2000):
+            self.test_random_changes()
+
+    def test_failed_save(self):
+        # a save that fails part way through writing the journal (the disk filling up, say) is saved in full the next
+        # time, and the part of it that was written doesn't get in the way
+        self.store.save({'a': [{'id': '1', 'text': 'one'}]}, ['a'])
+        self.store.save({'a': [{'id': '1', 'text': 'two'}]}, ['a'])
+
+        append_to_journal = self.store.append_to_journal
+        def fail(data, fsync_policy):
+            with open(self.store.journal_path, 'a') as file:
+                file.write(data[:5])
+            raise OSError('no space left')
+
+        self.store.append_to_journal = fail
+        with self.assertRaises(OSError):
+            self.store.save({'a': [{'id': '1', 'text': 'three'}]}, ['a'])
+
+        self.store.append_to_journal = append_to_journal
+        self.store.save({'a': [{'id': '1', 'text': 'three'}]}, ['a'])
+        self.store.save({'a': [{'id': '1', 'text': 'three'}, {'id': '2', 'text': 'four'}]}, ['a'])
+
+        self.assertEqual(self.create_store().load(), {'a': [{'id': '1', 'text': 'three'}, {'id': '2', 'text': 'four'}]})
+
+class SqliteStoreTest(StoreTests, unittest.TestCase):
+    def create_store(self):
+        return SqliteStore(self.directory.name)
+
+    def test_move_note(self):
+        # a note that moves to another group keeps its row, which has to end up in the right group
+        self.store.save({'a': [{'id': '1', 'text': 'one'}], 'b': [{'id': '2', 'text': 'two'}]}, ['a', 'b'])
+        self.store.save({'a': [], 'b': [{'id': '2', 'text': 'two'}, {'id': '1', 'text': 'one'}]}, ['a', 'b'])
+
+        self.assertStoreHas(self.create_store(),
+                            {'a': [], 'b': [{'id': '2', 'text': 'two'}, {'id': '1', 'text': 'one'}]})
+
+class BackupStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = BackupStore(self.directory.name)
+        self.manifests = []
+        self.backup_count = 0
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def back_up(self, notes_lists, keep=2):
+        # saves a backup, keeping the last `keep` of them, as FileHandler does
+        path = os.path.join(self.directory.name, 'backup-%d.manifest' % self.backup_count)
+        self.backup_count += 1
+        self.store.save(path, notes_lists, self.manifests[-1] if self.manifests else None, 'none')
+        self.manifests.append(path)
+        for old_path in self.manifests[:-keep]:
+            os.remove(old_path)
+        self.manifests = self.manifests[-keep:]
+        self.store.collect_garbage(self.manifests, 'none')
+
+    def get_packs(self):
+        # pack name -> the notes in it
+        packs = {}
+        for file in os.listdir(self.store.blobs_dir):
+            if file.endswith('.json'):
+                with open(os.path.join(self.store.blobs_dir, file), 'r') as pack_file:
+                    packs[file[:-len('.json')]] = json.loads(pack_file.read())
+
+        return packs
+
+    def test_collect_garbage(self):
+        notes = [{'id': str(number), 'text': 'note %d' % number} for number in range(10)]
+        self.back_up({'a': notes})
+        (first_pack,) = self.get_packs()
+
+        # the old versions of a few notes in the first pack aren't enough to rewrite it
+        for number in range(3):
+            notes = [dict(note, text=note['text'] + ' edited') if note['id'] == str(number) else note for note in notes]
+            with unittest.mock.patch('storage.write_file_atomic', wraps=write_file_atomic) as write:
+                self.back_up({'a': notes})
+
+            self.assertNotIn(self.store.get_pack_path(first_pack), [call.args[0] for call in write.call_args_list])
+            self.assertEqual(len(self.get_packs()[first_pack]), 10)
+        self.assertEqual(self.store.load(self.manifests[-1]), {'a': notes})
+
+        # once most of them are old, it is rewritten with only the ones that are still used, and packs with nothing
+        # that's still used are removed
+        for number in range(3, 10):
+            notes = [dict(note, text=note['text'] + ' edited') if note['id'] == str(number) else note for note in notes]
+        self.back_up({'a': notes}, keep=1)
+
+        packs = self.get_packs()
+        self.assertNotIn(first_pack, packs)
+        self.assertEqual(self.store.load(self.manifests[-1]), {'a': notes})
+        self.assertEqual({pack_name: sorted(hashes) for (pack_name, hashes) in self.store.read_pack_index().items()},
+                         {pack_name: sorted(pack) for (pack_name, pack) in packs.items()})
+
+    def test_missing_pack_index(self):
+        # packs that aren't in the index, such as ones from before there was one, are read to see what's in them
+        notes = [{'id': str(number), 'text': 'note %d' % number} for number in range(4)]
+        self.back_up({'a': notes})
+        os.remove(self.store.pack_index_path)
+
+        self.back_up({'a': notes[:1]}, keep=1)
+
+        self.assertEqual(self.store.load(self.manifests[-1]), {'a': notes[:1]})
+        self.assertEqual([len(pack) for pack in self.get_packs().values()], [1])
+        self.assertEqual([len(hashes) for hashes in self.store.read_pack_index().values()], [1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,14 +4,32 @@ import os
 import json
 import time
 import re
+import threading
 
 from gi.repository import Gio, GLib, GObject, Gtk
 
+from storage import (STORAGE_BACKENDS, BackupStore, add_derived_fields, convert_notes, create_store, generate_note_id,
+                     open_file, read_notes_lists, remove_derived_fields, remove_stale_temp_files, write_file_atomic)
+
 CONFIG_DIR = os.path.join(GLib.get_user_config_dir(), 'sticky')
+# Notes are stored per group, or per note when using the sqlite backend (see storage.py). notes.json is the old
+# single-file format, which is never written any more. If it's newer than the store (because an older version or
+# another program wrote it), its notes are imported in place of the ones in the store, and it's then renamed to
+# notes.json.migrated, so that nothing mistakes it for the current notes.
 CONFIG_PATH = os.path.join(CONFIG_DIR, 'notes.json')
+MIGRATED_CONFIG_PATH = CONFIG_PATH + '.migrated'
 SAVE_DELAY = 3
 
-backup_file_name = re.compile(r"\Abackup-[0-9]{10,}\.json$", re.IGNORECASE)
+# set STICKY_DEBUG_SAVES in the environment to print how long each save blocks the main loop
+DEBUG_SAVES = 'STICKY_DEBUG_SAVES' in os.environ
+
+# exports are compressed if they are saved with one of these extensions
+compressed_extensions = [('.json.gz', 'gzip'), ('.json.xz', 'xz')]
+
+# backup-<timestamp>.manifest is the current backup format (see storage.BackupStore). backup-<timestamp>.json files are
+# full copies of the notes, made by older versions
+
+backup_file_name = re.compile(r"\Abackup-([0-9]{10,})\.(json|manifest)$", re.IGNORECASE)
 
 class FileHandler(GObject.Object):
     @GObject.Signal(flags=GObject.SignalFlags.RUN_LAST, return_type=bool,
@@ -43,31 +61,191 @@ class FileHandler(GObject.Object):
         self.window = window
         self.save_timer_id = 0
         self.backup_timer_id = 0
+        self.backup_thread = None
+
+        # group name -> notes, in order. With lazy loading, groups that haven't been asked for yet are None and are only
+        # read from the store once get_note_list() needs them
         self.notes_lists = {}
 
-        if os.path.exists(CONFIG_PATH):
-            self.load_notes()
+        # saves are serialized and written on a worker thread. Only one save runs at a time - if another is requested
+        # while one is in progress, it is run as soon as the current one finishes.
+        self.save_thread = None
+        self.save_pending = False
+        # (error or None, changed groups, group names) once the worker has finished, until finish_save() handles it
+        self.save_result = None
+
+        # groups that may have changed since the last save
+        self.dirty_groups = set()
 
+        # What the store last wrote successfully, so that we can tell when a dirty group is actually identical to what's
+        # already saved. Comparing against these is much cheaper than serializing the groups to hash them, and catches
+        # the common cases of a note being refocused or a window being moved by zero pixels.
+        self.saved_groups = {}
+        self.saved_group_names = None
+
+        # how many saves have gone through, and how many were skipped because nothing had changed
+        self.save_counts = {'written': 0, 'skipped': 0}
+
+        self.backend = self.settings.get_string('storage-backend')
+        self.store = create_store(self.backend, CONFIG_DIR)
+        self.backup_store = BackupStore(CONFIG_DIR)
+
+        remove_stale_temp_files(CONFIG_DIR)
+        remove_stale_temp_files(os.path.join(CONFIG_DIR, 'groups'))
+        remove_stale_temp_files(self.backup_store.blobs_dir)
+
+        self.load_notes()
+
+        self.settings.connect('changed::storage-backend', self.on_storage_backend_changed)
         self.settings.connect('changed::automatic-backups', self.check_backup)
         self.settings.connect('changed::backup-interval', self.check_backup)
         self.check_backup()
 
     def load_notes(self, *args):
-        with open(CONFIG_PATH, 'r') as file:
-            info = json.loads(file.read())
+        # the notes are in the current store, unless the storage backend was changed while we weren't running
+        store = self.store if self.store.exists() else self.find_old_store()
+        if os.path.exists(CONFIG_PATH) and store is not None and \
+           os.path.getmtime(CONFIG_PATH) <= store.get_modified_time():
+            # the notes in it have already been imported
+            os.replace(CONFIG_PATH, MIGRATED_CONFIG_PATH)
+
+        if os.path.exists(CONFIG_PATH):
+            self.migrate_notes()
+        elif store is self.store:
+            self.notes_lists = {group_name: None for group_name in self.store.load_index()}
+            self.dirty_groups.clear()
+            self.saved_groups = {}
+            self.saved_group_names = self.get_note_group_names()
+
+            if not self.settings.get_boolean('lazy-loading'):
+                self.load_all_groups()
+        elif store is not None:
+            self.migrate_notes(store)
+
+    def load_group(self, group_name):
+        notes = self.store.load_group(group_name)
+        self.saved_groups[group_name] = [note.copy() for note in notes]
+
+        # the stores only ever contain notes that went through here before, so the ids will already be unique across
+        # groups, and checking each group on its own is enough to catch notes that are missing one
+        self.ensure_note_ids(notes)
+        self.notes_lists[group_name] = notes
+
+        # Notes are read in either format, but the ones that aren't in the one that's set are converted now, as their
+        # group is loaded, rather than all at once. Groups saved by older versions don't have the derived fields yet
+        # either. Both are saved again straight away.
+        converted = convert_notes(notes, self.settings.get_string('note-format'))
+        if add_derived_fields(notes) or converted:
+            self.dirty_groups.add(group_name)
+            self.queue_save()
+
+        return notes
+
+    def load_all_groups(self):
+        for group_name, notes in list(self.notes_lists.items()):
+            if notes is None:
+                self.load_group(group_name)
+
+    def find_old_store(self):
+        # returns the store for another storage backend, if there's one with notes in it
+        for backend in STORAGE_BACKENDS:
+            store = create_store(backend, CONFIG_DIR)
+            if backend != self.backend and store.exists():
+                return store
+
+        return None
+
+    def migrate_notes(self, old_store=None):
+        # Copies the notes from `old_store` to the current store, or if it's None, imports them from notes.json (see
+        # CONFIG_PATH), replacing anything that's in the store.
+        if old_store is not None:
+            info = old_store.load()
+        else:
+            with open(CONFIG_PATH, 'r') as file:
+                info = read_notes_lists(file)
+
+        seen_ids = set()
+        note_format = self.settings.get_string('note-format')
+        for notes in info.values():
+            self.ensure_note_ids(notes, seen_ids)
+            convert_notes(notes, note_format)
+            add_derived_fields(notes)
+
+        if old_store is None:
+            # a save that's still being written would end up in the store after it has been cleared, and a backup may
+            # still be reading from it
+            if self.save_thread is not None:
+                self.finish_save()
+            self.wait_for_backup()
+            self.store.delete()
 
         self.notes_lists = info
+        self.mark_all_dirty()
+        self.flush()
+
+        if old_store is not None:
+            old_store.delete()
+        else:
+            os.replace(CONFIG_PATH, MIGRATED_CONFIG_PATH)
+
+    def on_storage_backend_changed(self, *args):
+        backend = self.settings.get_string('storage-backend')
+        if backend == self.backend:
+            return
+
+        # make sure everything is in the old store, then copy it all over to the new one
+        self.flush()
+        self.load_all_groups()
+
+        old_store = self.store
+        self.backend = backend
+        self.store = create_store(backend, CONFIG_DIR)
+        self.store.delete()
+
+        self.mark_all_dirty()
+        self.flush()
+
+        # a backup may still be reading from the old store
+        self.wait_for_backup()
+        old_store.delete()
+
+    def mark_all_dirty(self):
+        # forces everything to be written on the next save
+        self.load_all_groups()
+        self.dirty_groups = set(self.notes_lists.keys())
+        self.saved_groups = {}
+        self.saved_group_names = None
+
+    def ensure_note_ids(self, notes, seen_ids=None):
+        # every note needs a unique id so that the storage backends can tell which notes have changed
+        if seen_ids is None:
+            seen_ids = set()
+
+        for note in notes:
+            if note.get('id') is None or note['id'] in seen_ids:
+                note['id'] = generate_note_id()
+
+            seen_ids.add(note['id'])
 
     def get_note_list(self, group_name):
+        if self.notes_lists[group_name] is None:
+            return self.load_group(group_name)
+
         return self.notes_lists[group_name]
 
     def get_note_group_names(self):
         return list(self.notes_lists.keys())
 
     def update_note_list(self, notes_list, group_name):
+        self.ensure_note_ids(notes_list)
+        add_derived_fields(notes_list, self.notes_lists.get(group_name))
         self.notes_lists[group_name] = notes_list
 
-        self.queue_save()
+        # there's no need to wait for a save if nothing changed, but if there's one pending anyway we still mark the
+        # group in case it was changed and then changed back
+        if group_name in self.dirty_groups or notes_list != self.saved_groups.get(group_name):
+            self.dirty_groups.add(group_name)
+            self.queue_save()
 
         self.emit('group-changed', group_name)
 
@@ -77,18 +255,131 @@ class FileHandler(GObject.Object):
 
         self.save_timer_id = GLib.timeout_add_seconds(SAVE_DELAY, self.save_note_list)
 
+    def snapshot_note_lists(self):
+        # the note lists (and the notes in them) can be modified on the main thread while a save is in progress, so we
+        # make a copy of the groups that need to be written to hand off to the worker. Returns None if there's nothing
+        # to save. What's in the snapshot only becomes what's saved once it has been written (see commit_snapshot()).
+        changed_groups = {}
+        for group_name in self.dirty_groups:
+            if group_name not in self.notes_lists or self.notes_lists[group_name] == self.saved_groups.get(group_name):
+                continue
+
+            changed_groups[group_name] = [note.copy() for note in self.notes_lists[group_name]]
+
+        self.dirty_groups.clear()
+
+        group_names = self.get_note_group_names()
+        if len(changed_groups) == 0 and group_names == self.saved_group_names:
+            self.save_counts['skipped'] += 1
+
+            if DEBUG_SAVES:
+                print('save: skipped, nothing changed (%d written, %d skipped)' %
+                      (self.save_counts['written'], self.save_counts['skipped']))
+
+            return None
+
+        self.save_counts['written'] += 1
+
+        return changed_groups, group_names
+
+    def commit_snapshot(self, changed_groups, group_names):
+        # called once a snapshot has been written, so that we can tell when the groups are changed again
+        self.saved_groups.update(changed_groups)
+        for group_name in list(self.saved_groups.keys()):
+            if group_name not in group_names:
+                del self.saved_groups[group_name]
+        self.saved_group_names = group_names
+
+    def write_to_file(self, file_path, notes_lists, fsync_policy, compression='none'):
+        # json.dump() writes the output a piece at a time, so an export never has to hold all of it in memory at once
+        write_file_atomic(file_path, lambda file: json.dump(notes_lists, file, indent=4), fsync_policy, compression)
+
     def save_to_file(self, file_path):
-        with open(file_path, 'w+') as file:
-            file.write(json.dumps(self.notes_lists, indent=4))
+        compression = 'none'
+        for (extension, file_compression) in compressed_extensions:
+            if file_path.lower().endswith(extension):
+                compression = file_compression
+
+        self.load_all_groups()
+        self.write_to_file(file_path, self.notes_lists, self.settings.get_string('fsync-policy'), compression)
 
     def save_note_list(self):
         self.save_timer_id = 0
 
+        if self.save_thread is not None:
+            self.save_pending = True
+            return False
+
+        start_time = time.perf_counter()
+
+        snapshot = self.snapshot_note_lists()
+        if snapshot is None:
+            return False
+
         if not os.path.exists(CONFIG_DIR):
             os.makedirs(CONFIG_DIR)
 
-        self.save_to_file(CONFIG_PATH)
+        (changed_groups, group_names) = snapshot
+        fsync_policy = self.settings.get_string('fsync-policy')
+        self.save_thread = threading.Thread(target=self.save_worker, args=(changed_groups, group_names, fsync_policy), daemon=True)
+        self.save_thread.start()
+
+        if DEBUG_SAVES:
+            print('save: main loop blocked for %.2f ms' % ((time.perf_counter() - start_time) * 1000))
+
+        return False
+
+    def save_worker(self, changed_groups, group_names, fsync_policy):
+        start_time = time.perf_counter()
+        error = None
+        try:
+            self.store.save(changed_groups, group_names, fsync_policy)
+        except Exception as e:
+            error = e
+
+        if DEBUG_SAVES:
+            print('save: %d of %d groups written in background in %.2f ms (%d written, %d skipped)' %
+                  (len(changed_groups), len(group_names), (time.perf_counter() - start_time) * 1000,
+                   self.save_counts['written'], self.save_counts['skipped']))
+
+        # the result is kept here rather than only passed to on_save_finished(), as flush() may handle it first
+        self.save_result = (error, changed_groups, group_names)
+        GLib.idle_add(self.on_save_finished, threading.current_thread())
+
+    def on_save_finished(self, thread):
+        # flush() may have already handled this save, and started (and even finished) another one since
+        if thread is not self.save_thread:
+            return False
+
+        succeeded = self.finish_save()
+
+        if self.save_pending:
+            self.save_pending = False
+            self.save_note_list()
+        elif not succeeded:
+            self.queue_save()
+
+        return False
+
+    def finish_save(self):
+        # waits for the save on the worker thread to finish, and deals with how it went. Returns whether it succeeded.
+        self.save_thread.join()
+        self.save_thread = None
+        (error, changed_groups, group_names) = self.save_result
+        self.save_result = None
+
+        if error is not None:
+            print('unable to save notes: %s' % error)
+            # make sure we try again next time
+            self.dirty_groups.update(changed_groups)
+            for group_name in changed_groups:
+                self.saved_groups.pop(group_name, None)
+            self.saved_group_names = None
+            return False
+
+        self.commit_snapshot(changed_groups, group_names)
         self.emit('saved')
+        return True
 
     def check_backup(self, *args):
         if self.backup_timer_id:
@@ -118,33 +409,90 @@ class FileHandler(GObject.Object):
     def save_backup(self, *args):
         self.backup_timer_id = 0
 
+        # hashing every note can take a while with a lot of notes, so like saves, backups are done on a worker thread
+        if self.backup_thread is not None:
+            return False
+
         if not os.path.exists(CONFIG_DIR):
             os.makedirs(CONFIG_DIR)
 
         timestamp = int(time.time())
-        path = os.path.join(CONFIG_DIR, 'backup-%d.json' % timestamp)
-        self.save_to_file(path)
+        path = os.path.join(CONFIG_DIR, 'backup-%d.manifest' % timestamp)
+        # Groups that haven't been loaded yet haven't changed since they were saved, so the worker reads them from the
+        # store rather than loading them here, which would undo lazy loading whenever a backup is due at startup
+        snapshot = {group_name: None if notes is None else [note.copy() for note in notes]
+                    for group_name, notes in self.notes_lists.items()}
 
-        self.settings.set_uint('latest-backup', timestamp)
+        args = (path, snapshot, self.store, self.settings.get_uint('old-backups-max'),
+                self.settings.get_string('fsync-policy'), self.settings.get_string('backup-compression'))
+        self.backup_thread = threading.Thread(target=self.backup_worker, args=args, daemon=True)
+        self.backup_thread.start()
 
-        # remove old backups (if applicable)
-        backups_keep = self.settings.get_uint('old-backups-max')
-        if backups_keep > 0:
-            backups = []
-            for file in os.listdir(CONFIG_DIR):
-                if backup_file_name.search(file):
-                    backups.append(file)
+        return False
 
-            backups.sort()
-            for file in backups[0:-backups_keep]:
-                os.remove(os.path.join(CONFIG_DIR, file))
+    def backup_worker(self, path, snapshot, store, backups_keep, fsync_policy, compression):
+        error = None
+        try:
+            for group_name, notes in snapshot.items():
+                if notes is None:
+                    snapshot[group_name] = store.load_group(group_name)
 
-        self.check_backup()
+            manifests = [os.path.join(CONFIG_DIR, file) for file in self.get_backup_files() if file.endswith('.manifest')]
+            previous_manifest = manifests[-1] if len(manifests) > 0 else None
+            self.backup_store.save(path, snapshot, previous_manifest, fsync_policy, compression)
 
-    def delete_all_backups(self):
+            # remove old backups (if applicable)
+            if backups_keep > 0:
+                for file in self.get_backup_files()[0:-backups_keep]:
+                    os.remove(os.path.join(CONFIG_DIR, file))
+
+                manifests = [os.path.join(CONFIG_DIR, file) for file in self.get_backup_files() if file.endswith('.manifest')]
+                self.backup_store.collect_garbage(manifests, fsync_policy)
+        except Exception as e:
+            error = e
+
+        GLib.idle_add(self.on_backup_finished, error, int(backup_file_name.search(os.path.basename(path)).group(1)))
+
+    def wait_for_backup(self):
+        # on_backup_finished() still runs once it's idle, and finishes up as usual
+        if self.backup_thread is not None:
+            self.backup_thread.join()
+
+    def on_backup_finished(self, error, timestamp):
+        self.backup_thread.join()
+        self.backup_thread = None
+
+        if error is None:
+            self.settings.set_uint('latest-backup', timestamp)
+            self.check_backup()
+            return False
+
+        print('unable to back up notes: %s' % error)
+
+        # the last backup is still overdue, so rather than letting check_backup() try again straight away (and again
+        # and again if it keeps failing), we wait for the usual interval before the next try
+        if self.settings.get_boolean('automatic-backups') and not self.backup_timer_id:
+            interval = self.settings.get_uint('backup-interval')
+            self.backup_timer_id = GLib.timeout_add_seconds(interval * 3600, self.save_backup)
+
+        return False
+
+    def get_backup_files(self):
+        backups = []
         for file in os.listdir(CONFIG_DIR):
             if backup_file_name.search(file):
-                os.remove(os.path.join(CONFIG_DIR, file))
+                backups.append(file)
+
+        # this sorts them from oldest to newest
+        backups.sort()
+
+        return backups
+
+    def delete_all_backups(self):
+        for file in self.get_backup_files():
+            os.remove(os.path.join(CONFIG_DIR, file))
+
+        self.backup_store.delete()
 
     def export_notes(self, menuitem, window):
         file_dialog = Gtk.FileChooserDialog(title=_("Export..."), action=Gtk.FileChooserAction.SAVE, transient_for=window)
@@ -158,11 +506,27 @@ class FileHandler(GObject.Object):
         json_filter.add_mime_type('application/json')
         file_dialog.add_filter(json_filter)
 
+        compressed_filter = Gtk.FileFilter()
+        compressed_filter.set_name(_("Compressed JSON"))
+        for (extension, compression) in compressed_extensions:
+            compressed_filter.add_pattern('*' + extension)
+        file_dialog.add_filter(compressed_filter)
+
         text_filter = Gtk.FileFilter()
         text_filter.set_name(_("Plain Text"))
         text_filter.add_mime_type('text/plain')
         file_dialog.add_filter(text_filter)
 
+        def on_filter_changed(*args):
+            # the file name decides whether the export is compressed, so keep it in line with the selected filter
+            name = file_dialog.get_current_name()
+            if file_dialog.get_filter() == compressed_filter and name.endswith('.json'):
+                file_dialog.set_current_name(name + '.gz')
+            elif file_dialog.get_filter() == json_filter and name.endswith('.json.gz'):
+                file_dialog.set_current_name(name[:-len('.gz')])
+
+        file_dialog.connect('notify::filter', on_filter_changed)
+
         response = file_dialog.run()
         if response == Gtk.ResponseType.OK:
             file = file_dialog.get_filename()
@@ -180,6 +544,12 @@ class FileHandler(GObject.Object):
         json_filter.add_mime_type('application/json')
         file_dialog.add_filter(json_filter)
 
+        compressed_filter = Gtk.FileFilter()
+        compressed_filter.set_name(_("Compressed JSON"))
+        for (extension, compression) in compressed_extensions:
+            compressed_filter.add_pattern('*' + extension)
+        file_dialog.add_filter(compressed_filter)
+
         text_filter = Gtk.FileFilter()
         text_filter.set_name(_("Plain Text"))
         text_filter.add_mime_type('text/plain')
@@ -211,18 +581,13 @@ class FileHandler(GObject.Object):
 
         content.pack_start(scrolled_window, True, True, 0)
 
-        backups = []
-        for file in os.listdir(CONFIG_DIR):
-            if backup_file_name.search(file):
-                backups.append(file)
-
-        backups.sort()
+        backups = self.get_backup_files()
 
         if len(backups) == 0:
             restore_button.set_sensitive(False)
 
         for file_name in backups:
-            date = time.localtime(int(file_name[7:-5]))
+            date = time.localtime(int(backup_file_name.search(file_name).group(1)))
             label = Gtk.Label(label=time.strftime('%c', date), margin=5)
             label.file = file_name
             backup_list.add(label)
@@ -241,13 +606,26 @@ class FileHandler(GObject.Object):
 
     def load_notes_from_path(self, path, window):
         try:
-            with open(path, 'r') as file:
-                info = json.loads(file.read())
-
-            # todo: needs validation here to ensure the file type is correct, and while we're at it, the validation
-            # should really be added to load_notes() as well
-
+            if path.endswith('.manifest'):
+                info = self.backup_store.load(path)
+            else:
+                # exports may be compressed, which open_file() takes care of
+                with open_file(path) as file:
+                    info = read_notes_lists(file)
+
+            # the file may have been edited by hand, so the derived fields can't be trusted to match the text
+            seen_ids = set()
+            note_format = self.settings.get_string('note-format')
+            for notes in info.values():
+                self.ensure_note_ids(notes, seen_ids)
+                remove_derived_fields(notes)
+                convert_notes(notes, note_format)
+                add_derived_fields(notes)
+
+            # the notes are only swapped in once they've all been read and prepared, so that nothing has been changed
+            # if anything about the file turns out to be invalid
             self.notes_lists = info
+            self.mark_all_dirty()
             self.save_note_list()
 
             self.emit('lists-changed')
@@ -260,8 +638,30 @@ class FileHandler(GObject.Object):
     def flush(self):
         if self.save_timer_id > 0:
             GLib.source_remove(self.save_timer_id)
+            self.save_timer_id = 0
 
-        self.save_note_list()
+        # this is used when quitting, so we write synchronously rather than handing off to the worker. If a save on the
+        # worker failed, its groups are marked dirty again, and written here along with everything else.
+        if self.save_thread is not None:
+            self.finish_save()
+        self.save_pending = False
+
+        start_time = time.perf_counter()
+
+        snapshot = self.snapshot_note_lists()
+        if snapshot is None:
+            return
+
+        if not os.path.exists(CONFIG_DIR):
+            os.makedirs(CONFIG_DIR)
+
+        (changed_groups, group_names) = snapshot
+        self.store.save(changed_groups, group_names, self.settings.get_string('fsync-policy'))
+        self.commit_snapshot(changed_groups, group_names)
+        self.emit('saved')
+
+        if DEBUG_SAVES:
+            print('save: flushed in %.2f ms' % ((time.perf_counter() - start_time) * 1000))
 
     def new_group(self, group_name):
         if group_name in self.notes_lists:
@@ -269,6 +669,7 @@ class FileHandler(GObject.Object):
                 return False
 
         self.notes_lists[group_name] = []
+        self.dirty_groups.add(group_name)
 
         self.save_note_list()
         self.emit('lists-changed')
@@ -282,12 +683,17 @@ class FileHandler(GObject.Object):
         if group_name not in self.notes_lists:
             raise ValueError('invalid group name %s' % group_name)
         del self.notes_lists[group_name]
+        self.dirty_groups.discard(group_name)
 
         self.save_note_list()
         self.emit('lists-changed')
 
     def change_group_name(self, old_group, new_group):
+        # the notes have to be written out under the new name, so they need to be loaded
+        self.get_note_list(old_group)
         self.notes_lists[new_group] = self.notes_lists.pop(old_group)
+        self.dirty_groups.discard(old_group)
+        self.dirty_groups.add(new_group)
 
         self.save_note_list()
         self.emit('group-name-changed', old_group, new_group)
@@ -1,40 +1,63 @@
 #!/usr/bin/python3
 
+import difflib
+import os
+import shutil
+
+import cairo
 from gi.repository import Gdk, Gio, GLib, GObject, Gtk, Pango, XApp
 from note_buffer import NoteBuffer
-from common import HoverBox
-from util import clean_text
+from common import CONFIG_DIR, HoverBox
+from markup import NOTE_TEXT_FIELDS, get_note_markup
+from search import SearchIndex, tokenize
+from search_pool import SearchPool
+from thumbnails import ThumbnailCache, get_thumbnail_key
 
 NOTE_TARGETS = [Gtk.TargetEntry.new('note-entry', Gtk.TargetFlags.SAME_APP, 1)]
 
+# how many notes are added to the search index each time the main loop is idle while it is being built
+SEARCH_INDEX_CHUNK = 200
+
+# only the best matches are shown, as each one needs a widget of its own
+SEARCH_RESULTS_MAX = 100
+
+# how many search results are added to the view each time the main loop is idle
+SEARCH_RESULTS_CHUNK = 10
+
+# With this many notes or more, searches are spread across worker processes (see search_pool.py). Below it, starting
+# the workers and sending them the notes costs more than it saves.
+SEARCH_POOL_THRESHOLD = 50000
+
+# how often (in milliseconds) to check whether the workers have finished a search
+SEARCH_POOL_POLL_INTERVAL = 10
+
+# previews get their contents when they come within this many pages of the visible part of the note view
+PREVIEW_OVERSCAN = 1
+
+# The contents of a preview are a thumbnail of the note, which PreviewRecycler renders (or finds in its cache) once the
+# preview comes near the visible part of the note view. Until then it's just the title, at the same size. While the
+# thumbnail is being rendered, the preview has a Gtk.TextView with a NoteBuffer.
 class NoteEntry(Gtk.Container):
     initialized = False
 
-    def __init__(self, item, settings):
+    def __init__(self, item, recycler):
         super(NoteEntry, self).__init__(height_request=150,
                                         width_request=150,
                                         valign=Gtk.Align.START,
                                         halign=Gtk.Align.CENTER)
 
         self.item = item
-        self.settings = settings
+        self.recycler = recycler
 
         self.set_has_window(False)
-        self.style_manager = XApp.StyleManager(widget=self)
 
         self.title_bar = Gtk.Box(name='title-bar', visible=True)
         self.title_bar.pack_start(Gtk.Label(label=item.title, name='title', visible=True, margin_top=5, margin_bottom=5, ellipsize=Pango.EllipsizeMode.END), False, False, 0)
         self.title_bar.set_parent(self)
 
-        self.buffer = NoteBuffer()
-        self.text = Gtk.TextView(wrap_mode=Gtk.WrapMode.WORD_CHAR, populate_all=True, buffer=self.buffer, visible=True, sensitive=False)
-        self.text.set_parent(self)
-
-        self.buffer.set_view(self.text)
-        self.buffer.set_from_internal_markup(item.text)
-
-        self.settings.connect('changed::font', self.set_font)
-        self.set_font()
+        self.text = None
+        self.thumbnail = None
+        self.title_bar_height = 0
 
         self.set_tooltip_text(item.title)
 
@@ -42,10 +65,39 @@ class NoteEntry(Gtk.Container):
 
         self.show_all()
 
+    def set_text_view(self, text_view):
+        self.text = text_view
+        self.text.get_buffer().set_from_markup(get_note_markup(self.item.info))
+        self.text.set_parent(self)
+        self.queue_resize()
+
+    def take_text_view(self):
+        text_view = self.text
+        self.text = None
+        text_view.unparent()
+
+        return text_view
+
+    def set_thumbnail(self, thumbnail):
+        self.thumbnail = thumbnail
+        self.queue_draw()
+
+    def get_content_size(self):
+        return (self.get_allocated_width() - 20, self.get_allocated_height() - self.title_bar_height - 20)
+
+    def do_draw(self, cr):
+        Gtk.Container.do_draw(self, cr)
+
+        if self.thumbnail is not None:
+            cr.set_source_surface(self.thumbnail, 10, self.title_bar_height + 10)
+            cr.paint()
+
+        return False
+
     def do_size_allocate(self, allocation):
         Gtk.Widget.do_size_allocate(self, allocation)
 
-        title_bar_height = self.title_bar.get_preferred_height()[1]
+        title_bar_height = self.title_bar_height = self.title_bar.get_preferred_height()[1]
 
         title_rect = Gdk.Rectangle()
         title_rect.x = allocation.x
@@ -54,12 +106,13 @@ class NoteEntry(Gtk.Container):
         title_rect.height = title_bar_height
         self.title_bar.size_allocate(title_rect)
 
-        content_rect = Gdk.Rectangle()
-        content_rect.x = allocation.x + 10
-        content_rect.y = allocation.y + title_bar_height + 10
-        content_rect.width = allocation.width - 20
-        content_rect.height = allocation.height - title_bar_height - 20
-        self.text.size_allocate(content_rect)
+        if self.text is not None:
+            content_rect = Gdk.Rectangle()
+            content_rect.x = allocation.x + 10
+            content_rect.y = allocation.y + title_bar_height + 10
+            content_rect.width = allocation.width - 20
+            content_rect.height = allocation.height - title_bar_height - 20
+            self.text.size_allocate(content_rect)
 
         self.set_clip(allocation)
 
@@ -79,7 +132,8 @@ class NoteEntry(Gtk.Container):
         if not self.initialized:
             return
 
-        self.text.unparent()
+        # the text view (if it still has one) goes back to be used for another preview
+        self.recycler.hide(self)
 
         self.initialized = False
         Gtk.Container.do_destroy(self)
@@ -87,10 +141,188 @@ class NoteEntry(Gtk.Container):
     def do_forall(self, include_internals, callback, *args):
         if include_internals:
             callback(self.title_bar, *args)
-            callback(self.text, *args)
+            if self.text is not None:
+                callback(self.text, *args)
+
+# Gives the previews in the note view their thumbnails as they scroll into view (or close to it), and drops them from
+# the ones that scroll away, so that opening a group with thousands of notes doesn't mean creating and filling a text
+# view for every one of them. Thumbnails that aren't cached yet are rendered from a text view, which is then kept to be
+# reused for the next one.
+class PreviewRecycler(object):
+    def __init__(self, note_view, adjustment, settings):
+        self.note_view = note_view
+        self.adjustment = adjustment
+        self.settings = settings
+
+        # NoteEntrys that are in range, the ones among them that have a text view for their thumbnail to be rendered
+        # from, and text views that aren't in use
+        self.live_entries = set()
+        self.rendering = set()
+        self.spare_text_views = []
+        self.model = None
+        self.update_id = 0
+        self.render_id = 0
+
+        self.settings.connect('changed::preview-disk-cache', self.create_thumbnail_cache)
+        self.create_thumbnail_cache()
+
+        # every preview uses the same font, so it's set once for the whole view
+        self.style_manager = XApp.StyleManager(widget=self.note_view)
+        self.settings.connect('changed::font', self.set_font)
+        self.set_font()
+
+        Gtk.Settings.get_default().connect('notify::gtk-theme-name', self.refresh)
+
+        self.adjustment.connect('value-changed', self.queue_update)
+        self.adjustment.connect('changed', self.queue_update)
+        self.note_view.connect('size-allocate', self.queue_update)
+
+    def create_thumbnail_cache(self, *args):
+        directory = os.path.join(CONFIG_DIR, 'thumbnails')
+        if self.settings.get_boolean('preview-disk-cache'):
+            self.thumbnails = ThumbnailCache(directory)
+        else:
+            # the thumbnails show what the notes say, so they're removed once they're no longer wanted
+            shutil.rmtree(directory, ignore_errors=True)
+            self.thumbnails = ThumbnailCache()
+
+    def remove_stale_thumbnails(self, notes_lists):
+        # removes the saved thumbnails of any notes that aren't in `notes_lists`, which has to have every group in it
+        self.thumbnails.remove_other_notes(note.get('id') for notes in notes_lists.values() for note in notes)
 
     def set_font(self, *args):
         self.style_manager.set_from_pango_font_string(self.settings.get_string('font'))
+        self.refresh()
+
+    def refresh(self, *args):
+        # the thumbnails that are showing have to be looked up (or rendered) again
+        for entry in list(self.live_entries):
+            self.hide(entry)
+
+        self.queue_update()
+
+    def bind_model(self, model, create_widget_func):
+        self.model = model
+        self.note_view.bind_model(model, create_widget_func)
+        self.queue_update()
+
+    def get_key(self, entry):
+        (width, height) = entry.get_content_size()
+        return get_thumbnail_key(entry.item.contents, entry.item.color, self.settings.get_string('font'),
+                                 Gtk.Settings.get_default().props.gtk_theme_name, entry.get_scale_factor(), width,
+                                 height)
+
+    def create_text_view(self):
+        buffer = NoteBuffer()
+        text_view = Gtk.TextView(wrap_mode=Gtk.WrapMode.WORD_CHAR, populate_all=True, buffer=buffer, visible=True, sensitive=False)
+        buffer.set_view(text_view)
+
+        return text_view
+
+    def show(self, entry):
+        self.live_entries.add(entry)
+
+        thumbnail = self.thumbnails.get(entry.item.info.get('id'), self.get_key(entry), entry.get_scale_factor())
+        if thumbnail is not None:
+            entry.set_thumbnail(thumbnail)
+            return
+
+        if len(self.spare_text_views) > 0:
+            text_view = self.spare_text_views.pop()
+        else:
+            text_view = self.create_text_view()
+
+        entry.set_text_view(text_view)
+        self.rendering.add(entry)
+        self.queue_render()
+
+    def hide(self, entry):
+        if entry.text is not None:
+            self.release(entry)
+
+        entry.set_thumbnail(None)
+        self.live_entries.discard(entry)
+
+    def release(self, entry):
+        self.spare_text_views.append(entry.take_text_view())
+        self.rendering.discard(entry)
+
+    def queue_render(self):
+        # this runs after the text views have been laid out and drawn
+        if self.render_id == 0:
+            self.render_id = GLib.idle_add(self.render, priority=GLib.PRIORITY_LOW)
+
+    def render(self):
+        self.render_id = 0
+
+        for entry in list(self.rendering):
+            text_view = entry.text
+            width = text_view.get_allocated_width()
+            height = text_view.get_allocated_height()
+            if width <= 1 or height <= 1:
+                # not laid out yet. That will queue an update, which brings us back here
+                continue
+
+            scale = text_view.get_scale_factor()
+            thumbnail = cairo.ImageSurface(cairo.FORMAT_ARGB32, width * scale, height * scale)
+            thumbnail.set_device_scale(scale, scale)
+            text_view.draw(cairo.Context(thumbnail))
+
+            self.thumbnails.add(entry.item.info.get('id'), self.get_key(entry), thumbnail)
+            self.release(entry)
+            entry.set_thumbnail(thumbnail)
+
+        return False
+
+    def queue_update(self, *args):
+        if self.update_id == 0:
+            self.update_id = GLib.idle_add(self.update)
+
+    def find_child(self, count, get_edge, y):
+        # the index of the first child where get_edge(allocation) is below `y`. The children are all the same size, so
+        # they are laid out in rows from top to bottom in order.
+        low = 0
+        high = count
+        while low < high:
+            middle = (low + high) // 2
+            if get_edge(self.note_view.get_child_at_index(middle).get_allocation()) <= y:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+    def update(self):
+        self.update_id = 0
+
+        count = self.model.get_n_items() if self.model is not None else 0
+
+        # the children haven't been laid out yet, and we'll be back once they have
+        if count > 0 and self.note_view.get_child_at_index(count - 1).get_allocated_height() <= 1:
+            return False
+
+        page_size = self.adjustment.get_page_size()
+        top = self.adjustment.get_value() - PREVIEW_OVERSCAN * page_size
+        bottom = self.adjustment.get_value() + (1 + PREVIEW_OVERSCAN) * page_size
+
+        # everything from the first child that ends below the top to the last one that starts above the bottom
+        start = self.find_child(count, lambda allocation: allocation.y + allocation.height, top)
+        end = self.find_child(count, lambda allocation: allocation.y + 1, bottom)
+
+        entries = set()
+        for index in range(start, end):
+            entries.add(self.note_view.get_child_at_index(index).entry)
+
+        for entry in self.live_entries - entries:
+            self.hide(entry)
+
+        for entry in entries - self.live_entries:
+            self.show(entry)
+
+        if len(self.rendering) > 0:
+            self.queue_render()
+
+        return False
 
 class GroupEntry(Gtk.ListBoxRow):
     def __init__(self, item):
@@ -217,11 +449,20 @@ class Note(GObject.Object):
         super(Note, self).__init__()
         self.info = info
         self.group_name = group_name
-        self.text = info['text']
+        (self.title, self.contents, self.color) = self.get_preview_fields(info)
+
+    @staticmethod
+    def get_preview_fields(info):
+        # everything about a note that shows in its preview
         if not 'title'in info or info['title'] in [None, '']:
-            self.title = _("Untitled")
+            title = _("Untitled")
         else:
-            self.title = info['title']
+            title = info['title']
+
+        # the text and formatting, in whichever format the note is in
+        contents = tuple(info.get(field) for field in NOTE_TEXT_FIELDS)
+
+        return (title, contents, info['color'])
 
 class NotesManager(object):
     def __init__(self, app, file_handler):
@@ -229,9 +470,27 @@ class NotesManager(object):
         self.dragged_note = None
         self.search_model = Gio.ListStore()
 
+        # The search index is built in the background when the search bar is opened (or something is searched for), and
+        # kept up to date after that
+        self.search_index = None
+        self.index_builder = None
+        self.index_builder_id = 0
+
+        # Searches run a bit at a time while the main loop is idle, and are cancelled if the search changes before
+        # they're done. search_cache is (index generation, words, scores) for all but the last word of the previous
+        # search, which are usually the same for the next one.
+        self.search_job = None
+        self.search_job_id = 0
+        self.search_cache = None
+        self.search_model_bound = False
+        self.search_pool = None
+
         self.file_handler = file_handler
         self.file_handler.connect('group-changed', self.on_list_changed)
+        self.file_handler.connect('lists-changed', self.on_lists_changed)
         self.file_handler.connect('lists-changed', self.generate_group_list)
+        self.file_handler.connect('lists-changed', self.remove_stale_thumbnails)
+        self.file_handler.connect('group-name-changed', self.on_group_name_changed)
 
         self.builder = Gtk.Builder()
         self.builder.set_translation_domain("sticky")
@@ -240,6 +499,8 @@ class NotesManager(object):
         self.window = self.builder.get_object('main_window')
         self.group_list = self.builder.get_object('group_list')
         self.note_view = self.builder.get_object('note_view')
+        self.previews = PreviewRecycler(self.note_view, self.builder.get_object('note_scroll').get_vadjustment(),
+                                        self.app.settings)
         self.note_view.connect('child-activated', self.on_note_activated)
         self.note_view.connect('selected-children-changed', self.on_selected_notes_changed)
 
@@ -257,6 +518,7 @@ class NotesManager(object):
         search_toggle = self.builder.get_object('search_toggle_button')
         self.search_bar = self.builder.get_object('search_bar')
         GObject.Object.bind_property(search_toggle, 'active', self.search_bar, 'search_mode_enabled', GObject.BindingFlags.BIDIRECTIONAL)
+        self.search_bar.connect('notify::search-mode-enabled', self.on_search_mode_changed)
 
         self.builder.get_object('new_note').connect('clicked', self.app.new_note)
         self.remove_note_button = self.builder.get_object('remove_note')
@@ -332,6 +594,7 @@ class NotesManager(object):
         self.window.show_all()
 
         self.generate_previews()
+        self.remove_stale_thumbnails()
         self.group_list.connect('row-selected', self.on_group_selected)
         self.group_list.connect('button-press-event', self.on_list_clicked)
         self.app.settings.connect('changed::active-group', self.on_active_group_changed)
@@ -341,6 +604,9 @@ class NotesManager(object):
             note.present_with_time(Gtk.get_current_event_time())
 
     def on_list_changed(self, a, group_name):
+        if self.search_index is not None:
+            self.search_index.update_group(group_name, self.file_handler.get_note_list(group_name))
+
         if group_name == self.get_current_group():
             self.generate_previews()
 
@@ -384,19 +650,185 @@ class NotesManager(object):
             self.generate_previews()
 
     def on_search_changed(self, *args):
+        self.cancel_search()
+
         search_text = self.search_box.get_text().lower().strip()
         if search_text == '':
             self.generate_previews()
 
         else:
-            self.search_model.remove_all()
+            self.search_job = self.run_search(search_text)
+            self.search_job_id = GLib.idle_add(self.continue_search)
+
+    def run_search(self, search_text):
+        # the index is built in the background, so we may have to wait for it to finish
+        self.start_indexing()
+        while self.index_builder is not None:
+            yield
+
+        group_names = self.file_handler.get_note_group_names()
+
+        results = None
+        if self.search_pool is not None and self.search_pool.is_ready():
+            futures = self.search_pool.search(self.search_index, search_text, group_names, SEARCH_RESULTS_MAX)
+            try:
+                # continue_search() waits for the workers without blocking the main loop
+                yield futures
+                results = list(self.search_pool.merge(self.search_index, futures, group_names, SEARCH_RESULTS_MAX))
+            except GeneratorExit:
+                for future in futures:
+                    future.cancel()
+                raise
+            except Exception as e:
+                # we can still search in this process, and the workers are started again next time
+                print("Search workers failed, searching in-process: %s" % e)
+                self.search_pool.shutdown()
+                self.search_pool = None
+        else:
+            # this starts the workers, or brings them up to date, in the background if there are enough notes
+            self.update_search_pool()
+
+        if results is None:
+            # Only the last word can still be being typed, so the scores for the words before it are kept for the next
+            # search, which then only has to look up the last word among the notes that matched them. Typing 'meeting
+            # notes' only goes through every note for 'meeting'.
+            words = tokenize(search_text)[:-1]
+            if len(words) > 0:
+                if self.search_cache is None or self.search_cache[:2] != (self.search_index.generation, words):
+                    self.search_cache = (self.search_index.generation, words, self.search_index.score_words(words))
+                    yield
+                known = (words, self.search_cache[2])
+            else:
+                known = None
+
+            results = list(self.search_index.search(search_text, group_names, SEARCH_RESULTS_MAX, known))
+            yield
+
+        # the old results stay up until the new ones are ready, and the new ones are then added a chunk at a time, as
+        # each one needs a widget
+        self.search_model.remove_all()
+        if not self.search_model_bound:
+            self.previews.bind_model(self.search_model, self.create_note_entry)
+            self.search_model_bound = True
+
+        for start in range(0, len(results), SEARCH_RESULTS_CHUNK):
+            notes = [Note(note_info, group_name) for (group_name, note_info) in results[start:start + SEARCH_RESULTS_CHUNK]]
+            self.search_model.splice(self.search_model.get_n_items(), 0, notes)
+            yield
+
+    def continue_search(self):
+        try:
+            futures = next(self.search_job)
+        except StopIteration:
+            self.search_job = None
+            self.search_job_id = 0
+            return False
+
+        if futures is None:
+            return True
+
+        # the job is waiting for the search workers, so we check back every now and then rather than spinning
+        self.search_job_id = GLib.timeout_add(SEARCH_POOL_POLL_INTERVAL, self.wait_for_search_pool, futures)
+        return False
+
+    def wait_for_search_pool(self, futures):
+        if not all(future.done() for future in futures):
+            return True
+
+        self.search_job_id = GLib.idle_add(self.continue_search)
+        return False
+
+    def update_search_pool(self):
+        if self.search_pool is None and len(self.search_index.notes) >= SEARCH_POOL_THRESHOLD:
+            self.search_pool = SearchPool()
+
+        if self.search_pool is not None:
+            self.search_pool.sync(self.search_index)
+
+    def cancel_search(self):
+        if self.search_job is not None:
+            GLib.source_remove(self.search_job_id)
+            self.search_job.close()
+            self.search_job = None
+            self.search_job_id = 0
+
+    def on_search_mode_changed(self, *args):
+        if self.search_bar.get_search_mode():
+            self.start_indexing()
+
+    def start_indexing(self):
+        if self.search_index is not None:
+            return
 
-            for group_name in self.file_handler.get_note_group_names():
-                for note_info in self.file_handler.get_note_list(group_name):
-                    if note_info['title'].lower().find(search_text) != -1 or clean_text(note_info['text']).find(search_text) != -1:
-                        self.search_model.append(Note(note_info, group_name))
+        self.search_index = SearchIndex()
+        self.index_builder = self.build_search_index()
+        self.index_builder_id = GLib.idle_add(self.continue_indexing)
 
-            self.note_view.bind_model(self.search_model, self.create_note_entry)
+    def build_search_index(self):
+        # Adds the notes to the index a chunk at a time, yielding in between. Changes that come in while this is running
+        # are added to the index straight away, and any notes that were already added are skipped over quickly, so it
+        # doesn't matter if a group has changed since the last chunk.
+        for group_name in self.file_handler.get_note_group_names():
+            # this loads any groups that haven't been loaded yet
+            end = 0
+            while end < len(self.file_handler.get_note_list(group_name)):
+                end += SEARCH_INDEX_CHUNK
+                self.search_index.update_group(group_name, self.file_handler.get_note_list(group_name)[0:end])
+                yield
+
+    def continue_indexing(self):
+        try:
+            next(self.index_builder)
+            return True
+        except StopIteration:
+            self.index_builder = None
+            self.index_builder_id = 0
+
+            # with a lot of notes, this gets the search workers ready before they're needed
+            self.update_search_pool()
+            # every group has been loaded now
+            self.remove_stale_thumbnails()
+            return False
+
+    def restart_indexing(self):
+        # used when groups are added, removed or renamed while the index is being built, as it's simpler to start
+        # again than to work out which of the groups that haven't been indexed yet are still there
+        GLib.source_remove(self.index_builder_id)
+        self.index_builder = None
+        self.index_builder_id = 0
+        self.search_index = None
+        self.start_indexing()
+
+    def on_lists_changed(self, *args):
+        if self.search_index is None:
+            return
+
+        if self.index_builder is not None:
+            self.restart_indexing()
+            return
+
+        # groups may have been added or removed, or everything replaced by a restore. Notes that are unchanged don't
+        # need to be tokenized again, so this is still a lot cheaper than starting over
+        group_names = self.file_handler.get_note_group_names()
+        for group_name in list(self.search_index.groups.keys()):
+            if group_name not in group_names:
+                self.search_index.remove_group(group_name)
+
+        for group_name in group_names:
+            self.search_index.update_group(group_name, self.file_handler.get_note_list(group_name))
+
+    def remove_stale_thumbnails(self, *args):
+        # With lazy loading, we can't tell which notes are in the groups that haven't been loaded yet, so this waits
+        # until they all have been (by a search or a backup, say)
+        notes_lists = self.file_handler.notes_lists
+        if None not in notes_lists.values():
+            self.previews.remove_stale_thumbnails(notes_lists)
+
+    def on_group_name_changed(self, file_handler, old_name, new_name):
+        if self.index_builder is not None:
+            self.restart_indexing()
+        elif self.search_index is not None:
+            self.search_index.rename_group(old_name, new_name)
 
     def open_search(self, *args):
         self.search_bar.set_search_mode(True)
@@ -428,18 +860,22 @@ class NotesManager(object):
 
         wrapper = Gtk.Box(halign=Gtk.Align.CENTER)
         context = wrapper.get_style_context()
-        context.add_class(item.info['color'])
+        context.add_class(item.color)
         context.add_class('note-preview')
         outer_box.pack_start(wrapper, False, False, 0)
 
-        entry = NoteEntry(item, self.app.settings)
+        entry = NoteEntry(item, self.previews)
         wrapper.pack_start(entry, False, False, 0)
 
+        widget.entry = entry
         widget.show_all()
 
         return widget
 
     def generate_previews(self, *args):
+        # a search that's still running would put its results back over the previews
+        self.cancel_search()
+
         selected_row = self.group_list.get_selected_row()
         if selected_row is None:
             return
@@ -448,12 +884,34 @@ class NotesManager(object):
         group_name = group_info.name
         model = group_info.model
 
-        model.remove_all()
-
-        for note in self.file_handler.get_note_list(group_name):
-            model.append(Note(note, group_name))
-
-        self.note_view.bind_model(model, self.create_note_entry)
+        self.update_preview_model(model, self.file_handler.get_note_list(group_name), group_name)
+
+        if self.previews.model is not model:
+            self.previews.bind_model(model, self.create_note_entry)
+        self.search_model_bound = False
+
+    def update_preview_model(self, model, notes, group_name):
+        # Brings `model` up to date with `notes`, only replacing the items for notes that were added, removed or changed
+        # in a way that shows in their previews. This runs every time the group is saved, which happens every few
+        # seconds while a note is being edited, and the other previews keep their widgets (and thumbnails).
+        items = [model.get_item(index) for index in range(model.get_n_items())]
+        matcher = difflib.SequenceMatcher(None, [item.info.get('id') for item in items],
+                                          [note.get('id') for note in notes], autojunk=False)
+
+        # going from the end means the positions of the parts we haven't got to yet don't change
+        for (tag, old_start, old_end, new_start, new_end) in reversed(matcher.get_opcodes()):
+            if tag != 'equal':
+                model.splice(old_start, old_end - old_start,
+                             [Note(note, group_name) for note in notes[new_start:new_end]])
+                continue
+
+            for (item, position, note) in zip(items[old_start:old_end], range(old_start, old_end),
+                                              notes[new_start:new_end]):
+                if (item.title, item.contents, item.color) != Note.get_preview_fields(note):
+                    model.splice(position, 1, [Note(note, group_name)])
+                else:
+                    # the rest of the note (where it is on the screen, say) can change without touching the preview
+                    item.info = note
 
     def get_current_group(self):
         row = self.group_list.get_selected_row()
@@ -533,6 +991,8 @@ class NotesManager(object):
     def duplicate_note(self, *args):
         selected = self.get_selected_note()
         note_info = selected.copy()
+        # the file handler will give it an id of its own
+        note_info.pop('id', None)
         note_info['x'] += 50
         note_info['y'] += 50
         group = self.get_current_group()
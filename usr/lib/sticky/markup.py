@@ -0,0 +1,284 @@
+#!/usr/bin/python3
+
+import re
+
+# Notes are saved as their text with markup in it:
+#   '##'            a '#' in the text
+#   '#check:0'      a checkbox that isn't checked ('#check:1' if it is)
+#   '#bullet:'      a bullet
+#   '#tag:<name>:'  where the tag <name> starts, and where it ends the next time it comes up
+# This module reads and writes that format without needing GTK, which only comes into it in NoteBuffer.
+
+# the character that stands in for an anchor (a checkbox or bullet) in the text, as it does in a Gtk.TextBuffer
+OBJECT_REPLACEMENT_CHAR = '\ufffc'
+
+# the tags NoteBuffer has, in the order it creates them, which is the order serialize_markup() needs them in to save
+# notes the same way NoteBuffer does
+TAG_NAMES = ['bold', 'italic', 'monospace', 'underline', 'strikethrough', 'highlight', 'link', 'header', 'small', 'large',
+             'larger']
+
+# Notes can be saved in either of these formats:
+#   'markup' - the markup is in the note's text. This is what older versions read, and notes in it have no 'format'
+#   'spans'  - the text is on its own (with OBJECT_REPLACEMENT_CHAR for the anchors), and the formatting is in
+#              'spans' ([[start, end, tag name]]) and 'anchors' ([[offset, 'check' or 'bullet', checked]]), with
+#              'format' set to SPANS_FORMAT_VERSION. Nothing has to be parsed to load or search these.
+NOTE_FORMATS = ['markup', 'spans']
+SPANS_FORMAT_VERSION = 2
+
+# the fields that make up a note's text, in either format
+NOTE_TEXT_FIELDS = ['text', 'format', 'spans', 'anchors']
+
+def escape_text(text):
+    return text.replace('#', '##')
+
+def format_tag(tag_name):
+    return '#tag:%s:' % tag_name
+
+def format_anchor(anchor_type, checked=False):
+    if anchor_type == 'check':
+        return '#check:' + str(int(checked))
+    elif anchor_type == 'bullet':
+        return '#bullet:'
+    else:
+        # anything else can't be saved
+        return ''
+
+def tokenize_markup(text):
+    # Yields the pieces of `text` in order, as ('text', text), ('check', checked), ('bullet', None) or ('tag', tag name).
+    # Each '#tag' token either starts or ends the tag, depending on whether it's already started.
+    current_index = 0
+    while True:
+        next_index = text.find('#', current_index)
+        if next_index == -1:
+            if current_index < len(text):
+                yield ('text', text[current_index:])
+            break
+
+        if next_index > current_index:
+            yield ('text', text[current_index:next_index])
+
+        if text[next_index:next_index+2] == '##':
+            yield ('text', '#')
+            current_index = next_index + 2
+        elif text[next_index:next_index+6] == '#check':
+            yield ('check', bool(int(text[next_index+7])))
+            current_index = next_index + 8
+        elif text[next_index:next_index+7] == '#bullet':
+            yield ('bullet', None)
+            current_index = next_index + 8
+        elif text[next_index:next_index+4] == '#tag':
+            end_tag_index = text.find(':', next_index+6)
+            tag_name = text[next_index+5:end_tag_index]
+            yield ('tag', tag_name)
+            current_index = next_index + 6 + len(tag_name)
+        else:
+            print('formatting error detected - attempting to fix')
+            yield ('text', '#')
+            current_index = next_index + 1
+
+# A note's contents without the markup: its text, with OBJECT_REPLACEMENT_CHAR where each anchor is, the anchors as
+# [(offset, 'check' or 'bullet', checked)] and the tags as [(tag name, start offset, end offset)], with the offsets into
+# the text. The anchors are in order, the tags can be in any order, and can overlap. An anchor of any other type is
+# kept in its place but left out of the markup, as is a OBJECT_REPLACEMENT_CHAR that isn't an anchor.
+class Markup(object):
+    def __init__(self, text='', anchors=None, tags=None):
+        self.text = text
+        self.anchors = anchors if anchors is not None else []
+        self.tags = tags if tags is not None else []
+
+    def __eq__(self, other):
+        if not isinstance(other, Markup):
+            return NotImplemented
+
+        return (self.text, self.anchors, self.tags) == (other.text, other.anchors, other.tags)
+
+    def split_anchors(self):
+        # Returns the pieces of text in between the checkboxes and bullets (one more than there are of them), for adding
+        # the text before them. Any other anchors are left in as OBJECT_REPLACEMENT_CHAR, so that the offsets still
+        # work out.
+        pieces = []
+        start = 0
+        for (offset, anchor_type, checked) in self.anchors:
+            if anchor_type in ('check', 'bullet'):
+                pieces.append(self.text[start:offset])
+                start = offset + 1
+        pieces.append(self.text[start:])
+
+        return pieces
+
+def parse_markup(text):
+    # Tags that are never closed are dropped, as they have always been when loading notes.
+    pieces = []
+    anchors = []
+    tags = []
+    open_tags = {}
+    length = 0
+
+    for (token_type, value) in tokenize_markup(text):
+        if token_type == 'text':
+            pieces.append(value)
+            length += len(value)
+        elif token_type == 'tag':
+            if value in open_tags:
+                tags.append((value, open_tags.pop(value), length))
+            else:
+                open_tags[value] = length
+        else:
+            pieces.append(OBJECT_REPLACEMENT_CHAR)
+            anchors.append((length, token_type, bool(value)))
+            length += 1
+
+    return Markup(''.join(pieces), anchors, tags)
+
+def serialize_markup(markup, tag_names=()):
+    # The inverse of parse_markup(). Wherever the tags change, the ones that end are closed (in the order they were
+    # opened) before the ones that start are opened (in the order they were last closed, starting with `tag_names` and
+    # then any others in the order they first come up). That's the order NoteBuffer has always saved them in, when
+    # `tag_names` is the order of its tags.
+    on_tags = []
+    off_tags = list(tag_names)
+    text = serialize_markup_part(markup, on_tags, off_tags)
+
+    # If there are any open tags at this point, it means they go to the end of the text, so close them
+    for tag_name in on_tags:
+        text.append(format_tag(tag_name))
+
+    return ''.join(text)
+
+def serialize_markup_part(markup, on_tags, off_tags):
+    # Serializes `markup` as a part of a longer text, where `on_tags` are the tags that are open at the start of it and
+    # `off_tags` are the rest, both in the order serialize_markup() keeps them in. Returns a list of strings to join,
+    # and leaves `on_tags` and `off_tags` as they are at the end of the part, without closing anything. Serializing the
+    # parts of a text one after another in this way gives exactly what serializing all of it at once does, as checking
+    # the tags where none of them change does nothing.
+    length = len(markup.text)
+
+    # offset -> [(tag name, +1 where a span starts or -1 where it ends)]
+    changes = {}
+    for (tag_name, start, end) in markup.tags:
+        (start, end) = (max(start, 0), min(end, length))
+        if start < end:
+            changes.setdefault(start, []).append((tag_name, 1))
+            changes.setdefault(end, []).append((tag_name, -1))
+
+        if tag_name not in on_tags and tag_name not in off_tags:
+            off_tags.append(tag_name)
+
+    anchors = {offset: (anchor_type, checked) for (offset, anchor_type, checked) in markup.anchors}
+    # the span count for each tag at the current offset, which can be more than 1 where spans overlap
+    counts = dict.fromkeys(on_tags + off_tags, 0)
+    offsets = sorted(offset for offset in changes if offset < length)
+    if len(offsets) == 0 or offsets[0] != 0:
+        offsets.insert(0, 0)
+
+    text = []
+    for (index, offset) in enumerate(offsets):
+        for (tag_name, change) in changes.get(offset, []):
+            counts[tag_name] += change
+
+        # first we close any open tags that don't continue on past this point
+        for tag_name in on_tags[:]:
+            if counts[tag_name] == 0:
+                text.append(format_tag(tag_name))
+                off_tags.append(tag_name)
+                on_tags.remove(tag_name)
+
+        # next we open any tags that start here
+        for tag_name in off_tags[:]:
+            if counts[tag_name] > 0:
+                text.append(format_tag(tag_name))
+                on_tags.append(tag_name)
+                off_tags.remove(tag_name)
+
+        run_start = offset
+        run_end = offsets[index + 1] if index + 1 < len(offsets) else length
+        while True:
+            anchor_offset = markup.text.find(OBJECT_REPLACEMENT_CHAR, run_start, run_end)
+            if anchor_offset == -1:
+                break
+
+            text.append(escape_text(markup.text[run_start:anchor_offset]))
+            if anchor_offset in anchors:
+                text.append(format_anchor(*anchors[anchor_offset]))
+            else:
+                text.append(OBJECT_REPLACEMENT_CHAR)
+
+            run_start = anchor_offset + 1
+
+        text.append(escape_text(markup.text[run_start:run_end]))
+
+    return text
+
+def join_markup(parts):
+    # Joins Markups that follow on from each other into one. A tag that runs from the end of one part into the start of
+    # the next becomes a single span (only the one, if there are several of the tag's spans at either side).
+    text = []
+    anchors = []
+    tags = []
+    # tag name -> the span in `tags` that ends where the current part starts, if there is one
+    open_spans = {}
+    length = 0
+
+    for part in parts:
+        text.append(part.text)
+        for (offset, anchor_type, checked) in part.anchors:
+            anchors.append((length + offset, anchor_type, checked))
+
+        ending_spans = {}
+        for (tag_name, start, end) in part.tags:
+            span = open_spans.pop(tag_name, None) if start == 0 else None
+            if span is not None:
+                span[2] = length + end
+            else:
+                span = [tag_name, length + start, length + end]
+                tags.append(span)
+
+            if end == len(part.text):
+                ending_spans[tag_name] = span
+
+        open_spans = ending_spans
+        length += len(part.text)
+
+    return Markup(''.join(text), anchors, [tuple(span) for span in tags])
+
+def get_note_format(note):
+    return 'spans' if note.get('format') == SPANS_FORMAT_VERSION else 'markup'
+
+def get_note_markup(note):
+    text = note.get('text') or ''
+    if get_note_format(note) == 'markup':
+        return parse_markup(text)
+
+    anchors = [(offset, anchor_type, bool(checked)) for (offset, anchor_type, checked) in note.get('anchors') or []]
+    tags = [(tag_name, start, end) for (start, end, tag_name) in note.get('spans') or []]
+    return Markup(text, anchors, tags)
+
+def get_note_fields(markup, note_format, tag_names=TAG_NAMES):
+    # returns the fields that save `markup` in a note in `note_format`
+    if note_format == 'markup':
+        return {'text': serialize_markup(markup, tag_names)}
+
+    # as with the markup format, anchors that aren't checkboxes or bullets aren't saved
+    return {
+        'format': SPANS_FORMAT_VERSION,
+        'text': markup.text,
+        'spans': [[start, end, tag_name] for (tag_name, start, end) in markup.tags if start < end],
+        'anchors': [[offset, anchor_type, checked] for (offset, anchor_type, checked) in markup.anchors
+                    if anchor_type in ('check', 'bullet')]
+    }
+
+def get_note_plain_text(note):
+    # the note's text without the markup or anchors, in either format
+    if get_note_format(note) == 'markup':
+        return get_plain_text(note.get('text') or '')
+
+    return ''.join(get_note_markup(note).split_anchors())
+
+# Matches the markup in a note's text: '##' (an escaped '#', kept in group 1), '#check:0', '#check:1', '#bullet:' and
+# '#tag:<name>:'. A '#' on its own shouldn't happen, and is dropped. This is quicker than parse_markup() when only the
+# text is needed.
+markup_pattern = re.compile(r'#(?:(#)|check.{0,2}|bullet.?|tag..[^:]*:)?', re.DOTALL)
+
+def get_plain_text(text):
+    # splitting on the markup gives the text in between, with whatever group 1 matched (a '#' or None) in between that
+    return ''.join(filter(None, markup_pattern.split(text)))
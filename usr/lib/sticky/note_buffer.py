@@ -1,6 +1,7 @@
 #!/usr/bin/python3
 
 from gi.repository import Gdk, GLib, GObject, Gtk, Pango
+from markup import OBJECT_REPLACEMENT_CHAR, Markup, format_tag, join_markup, parse_markup, serialize_markup_part
 from util import ends_with_url, get_url_start
 
 TAG_DEFINITIONS = {
@@ -422,7 +423,14 @@ class NoteBuffer(Gtk.TextBuffer):
         for name, attributes in TAG_DEFINITIONS.items():
             self.tags.append(self.create_tag(name, **attributes))
 
+        # the markup of each line (see update_line_cache()), or None if it hasn't been read yet
+        self.line_cache = None
+
         self.connect('delete-range', self.on_delete)
+        self.connect('delete-range', self.on_delete_lines)
+        self.connect('apply-tag', self.on_tag_changed)
+        self.connect('remove-tag', self.on_tag_changed)
+        self.connect('insert-child-anchor', self.on_anchor_inserted)
         self.connect('begin-user-action', self.begin_composite_action)
         self.connect('end-user-action', self.end_composite_action)
         self.connect('mark-set', self.on_mark_set)
@@ -479,93 +487,160 @@ class NoteBuffer(Gtk.TextBuffer):
 
         return InternalActionHandler()
 
-    def get_internal_markup(self):
-        on_tags = []
-        off_tags = self.tags.copy()
-        text = ''
-
-        current_iter = self.get_iter_at_offset(0)
-        while True:
-            # first we close any open tags that don't continue on to the current character
-            for tag in on_tags[:]:
-                if not current_iter.has_tag(tag):
-                    text += '#tag:%s:' % tag.props.name
-                    off_tags.append(tag)
-                    on_tags.remove(tag)
-
-            # next we open any tags that start with the current character
-            for tag in off_tags[:]:
-                if current_iter.has_tag(tag):
-                    text += '#tag:%s:' % tag.props.name
-                    on_tags.append(tag)
-                    off_tags.remove(tag)
-
-            current_char = current_iter.get_char()
-            if current_char == '#':
-                # we need to escape '#' characters to avoid misinterpretation when we parse it later
-                text += '##'
-            elif current_iter.get_child_anchor() is not None:
+    def read_markup(self, start, end):
+        # Returns the part of the buffer between `start` and `end` as a Markup, with offsets from `start`. The tags can
+        # only change where one of them toggles on or off, so rather than checking every tag at every character, we
+        # jump from one toggle to the next.
+        base = start.get_offset()
+        # get_slice() (unlike get_text()) keeps a placeholder character for each child anchor, so offsets into it are
+        # the same as offsets into the buffer
+        text = self.get_slice(start, end, True)
+
+        anchors = []
+        anchor_offset = text.find(OBJECT_REPLACEMENT_CHAR)
+        while anchor_offset != -1:
+            anchor = self.get_iter_at_offset(base + anchor_offset).get_child_anchor()
+            # otherwise it's just the same character
+            if anchor is not None:
                 # object insertions (bullets and checkboxes)
-                anchor_child = current_iter.get_child_anchor().get_widgets()[0]
+                anchor_child = anchor.get_widgets()[0]
                 if isinstance(anchor_child, Gtk.CheckButton):
-                    checked = anchor_child.get_active()
-                    text += '#check:' + str(int(checked))
+                    anchors.append((anchor_offset, 'check', anchor_child.get_active()))
                 elif isinstance(anchor_child, Gtk.Image):
-                    text += '#bullet:'
-            else:
-                text += current_char
+                    anchors.append((anchor_offset, 'bullet', False))
+                else:
+                    anchors.append((anchor_offset, None, False))
+
+            anchor_offset = text.find(OBJECT_REPLACEMENT_CHAR, anchor_offset + 1)
 
-            if not current_iter.forward_char():
+        tags = []
+        # tag -> where it started, for the ones that are on
+        tag_starts = {}
+        toggle_iter = start.copy()
+        while True:
+            offset = toggle_iter.get_offset() - base
+            for tag in self.tags:
+                if toggle_iter.has_tag(tag):
+                    if tag not in tag_starts:
+                        tag_starts[tag] = offset
+                elif tag in tag_starts:
+                    tags.append((tag.props.name, tag_starts.pop(tag), offset))
+
+            if not toggle_iter.forward_to_tag_toggle(None) or toggle_iter.compare(end) >= 0:
                 break
 
+        for (tag, tag_start) in tag_starts.items():
+            tags.append((tag.props.name, tag_start, len(text)))
+
+        return Markup(text, anchors, tags)
+
+    def update_line_cache(self):
+        # Brings self.line_cache up to date, reading the lines that have changed since the last time from the buffer.
+        # The handlers that keep track of the changes should catch all of them, but the text of each cached line is
+        # still checked against the buffer, which is cheap next to reading it again, so that a change to the text that
+        # was somehow missed only costs the line being read again rather than the note being saved wrong.
+        line_count = self.get_line_count()
+        if self.line_cache is None or len(self.line_cache) != line_count:
+            self.line_cache = [None] * line_count
+
+        text = self.get_slice(self.get_start_iter(), self.get_end_iter(), True)
+        offset = 0
+        for (line, entry) in enumerate(self.line_cache):
+            # every line but the last one ends with a line break, so a line's text can only match the start of
+            # another, longer line if it's the last one
+            if (entry is not None and text.startswith(entry[0].text, offset) and
+                    (line < line_count - 1 or offset + len(entry[0].text) == len(text))):
+                offset += len(entry[0].text)
+                continue
+
+            line_start = self.get_iter_at_line(line)
+            line_end = line_start.copy()
+            line_end.forward_line()
+            self.line_cache[line] = [self.read_markup(line_start, line_end), None]
+            offset = line_end.get_offset()
+
+    def get_markup(self):
+        # Returns the buffer's contents as a Markup. Only the lines that have changed are read again (see
+        # update_line_cache()).
+        self.update_line_cache()
+
+        return join_markup([entry[0] for entry in self.line_cache])
+
+    def get_internal_markup(self):
+        # Each line's markup is kept along with the tags that were open before and after it, and is only serialized
+        # again if the line has changed or a change before it has left different tags open at the start of it. The
+        # result is exactly what serializing the whole buffer at once gives (see serialize_markup_part()).
+        self.update_line_cache()
+
+        on_tags = []
+        off_tags = [tag.props.name for tag in self.tags]
+        text = []
+        for entry in self.line_cache:
+            serialized = entry[1]
+            if serialized is None or serialized[0] != (on_tags, off_tags):
+                tags_before = (on_tags[:], off_tags[:])
+                part = ''.join(serialize_markup_part(entry[0], on_tags, off_tags))
+                serialized = entry[1] = (tags_before, part, (on_tags[:], off_tags[:]))
+            else:
+                (on_tags, off_tags) = (serialized[2][0][:], serialized[2][1][:])
+
+            text.append(serialized[1])
+
         # If there are any open tags at this point, it means they go to the end of the text, so close them
-        for tag in on_tags:
-            text += '#tag:%s:' % tag.props.name
+        for tag_name in on_tags:
+            text.append(format_tag(tag_name))
 
-        return text
+        return ''.join(text)
+
+    def lines_changed(self, first_line, last_line, added_lines=0, removed_lines=0):
+        # Marks the lines from `first_line` to `last_line` as changed in self.line_cache, after removing the
+        # `removed_lines` that come after `first_line` and adding `added_lines` in their place.
+        if self.line_cache is None:
+            return
+
+        self.line_cache[first_line + 1:first_line + 1 + removed_lines] = [None] * added_lines
+        for line in range(first_line, min(last_line + 1, len(self.line_cache))):
+            self.line_cache[line] = None
+
+    def on_delete_lines(self, buffer, start, end):
+        # this runs after on_delete(), which can move `end` past a bullet or checkbox
+        self.lines_changed(start.get_line(), start.get_line(), removed_lines=end.get_line() - start.get_line())
+
+    def on_tag_changed(self, buffer, tag, start, end):
+        # ignore tags that don't have one of our names (i.e. spell checker)
+        if tag.props.name in TAG_DEFINITIONS:
+            self.lines_changed(start.get_line(), end.get_line())
+
+    def on_anchor_inserted(self, buffer, location, anchor):
+        self.lines_changed(location.get_line(), location.get_line())
+
+    def on_check_button_toggled(self, check_button, anchor):
+        if not anchor.get_deleted():
+            line = self.get_iter_at_child_anchor(anchor).get_line()
+            self.lines_changed(line, line)
+
+        self.trigger_changed()
 
     def set_from_internal_markup(self, text):
-        with self.internal_action(False):
-            self.set_text('')
+        self.set_from_markup(parse_markup(text))
 
-            current_index = 0
-            open_tags = {}
-            while True:
-                next_index = text.find('#', current_index)
-                if next_index == -1:
-                    self.insert(self.get_end_iter(), text[current_index:])
-                    break
+    def set_from_markup(self, markup):
+        # All of the text is added at once, followed by the checkboxes and bullets, in order so that each one ends up
+        # at its own offset, and the tags last, as their offsets count the anchors.
+        # the whole buffer is about to change, so it's quicker to start the line cache over than to keep it up to date
+        self.line_cache = None
+        with self.internal_action(False):
+            self.set_text(''.join(markup.split_anchors()))
 
-                self.insert(self.get_end_iter(), text[current_index:next_index])
-
-                if text[next_index:next_index+2] == '##':
-                    self.insert(self.get_end_iter(), '#')
-                    current_index = next_index + 2
-                elif text[next_index:next_index+6] == '#check':
-                    checked = bool(int(text[next_index+7]))
-                    self.add_check_button(self.get_end_iter(), checked=checked)
-                    current_index = next_index + 8
-                elif text[next_index:next_index+7] == '#bullet':
-                    self.add_bullet(self.get_end_iter())
-                    current_index = next_index + 8
-                elif text[next_index:next_index+4] == '#tag':
-                    end_tag_index = text.find(':', next_index+6)
-                    tag_name = text[next_index+5:end_tag_index]
-
-                    if tag_name in open_tags:
-                        mark = open_tags.pop(tag_name)
-                        start = self.get_iter_at_mark(mark)
-                        end = self.get_end_iter()
-                        self.apply_tag_by_name(tag_name, start, end)
-                        self.delete_mark(mark)
-                    else:
-                        open_tags[tag_name] = self.create_mark(None, self.get_end_iter(), True)
+            for (offset, anchor_type, checked) in markup.anchors:
+                if anchor_type == 'check':
+                    self.add_check_button(self.get_iter_at_offset(offset), checked=checked)
+                elif anchor_type == 'bullet':
+                    self.add_bullet(self.get_iter_at_offset(offset))
 
-                    current_index = next_index + 6 + len(tag_name)
-                else:
-                    print('formatting error detected - attempting to fix')
-                    self.insert(self.get_end_iter(), '#')
-                    current_index = next_index + 1
+            for (tag_name, start_offset, end_offset) in markup.tags:
+                self.apply_tag_by_name(tag_name, self.get_iter_at_offset(start_offset),
+                                       self.get_iter_at_offset(end_offset))
 
     def undo(self, *args):
         if len(self.undo_actions) == 0:
@@ -615,7 +690,10 @@ class NoteBuffer(Gtk.TextBuffer):
         position = location.get_offset()
 
         action = AdditionAction(self, text, location)
+        line = location.get_line()
+        line_count = self.get_line_count()
         Gtk.TextBuffer.do_insert_text(self, location, text, length)
+        self.lines_changed(line, line, added_lines=self.get_line_count() - line_count)
 
         if self.internal_action_count:
             return
@@ -836,7 +914,7 @@ class NoteBuffer(Gtk.TextBuffer):
         with self.internal_action():
             anchor = self.create_child_anchor(a_iter)
             check_button = CheckBox(visible=True, active=checked, margin_right=5, margin_top=5)
-            check_button.connect('toggled', self.trigger_changed)
+            check_button.connect('toggled', self.on_check_button_toggled, anchor)
             self.view.add_child_at_anchor(check_button, anchor)
 
             return ObjectInsertAction(self, anchor)
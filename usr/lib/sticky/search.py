@@ -0,0 +1,388 @@
+#!/usr/bin/python3
+
+import bisect
+import heapq
+import math
+import re
+import unicodedata
+
+from markup import get_note_plain_text
+
+token_pattern = re.compile(r'\w+')
+
+# Words in the notes that don't start with a query word can still match it if enough of the query word's trigrams are
+# in them, which catches most typos ('meetign' finds 'meeting') and words that contain the query word ('shop' finds
+# 'workshop'). This is the fraction of the trigrams that have to be there. Words shorter than FUZZY_MIN_LENGTH only
+# match the start of words, as they have too few trigrams to say much.
+FUZZY_THRESHOLD = 0.5
+FUZZY_MIN_LENGTH = 3
+
+# Results are ranked with BM25. A word in the title counts as much as this many occurrences in the text
+TITLE_WEIGHT = 3
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+def normalize(text):
+    # lower case and without accents, so that typing 'cafe' finds 'Café'
+    text = text.casefold()
+    if text.isascii():
+        return text
+
+    return ''.join(char for char in unicodedata.normalize('NFKD', text) if not unicodedata.combining(char))
+
+def tokenize(text):
+    return token_pattern.findall(normalize(text))
+
+def get_trigrams(word):
+    # the spaces make the start and end of the word count, so that 'cat' is closer to 'cats' than to 'scatter'
+    padded = ' %s ' % word
+    return {padded[index:index + 3] for index in range(len(padded) - 2)}
+
+# An inverted index over the titles and text of the notes, for the manager's search. Every query word has to match a
+# word in the note, either at the start, so that results keep up while a word is still being typed, or approximately
+# (see FUZZY_THRESHOLD). Results are ranked with BM25, scaled by how closely the words match. Groups are added with
+# update_group(), which only has to re-tokenize the notes whose title or text actually changed.
+class SearchIndex(object):
+    def __init__(self):
+        # token -> ids of the notes that contain it
+        self.postings = {}
+        # every token in self.postings, sorted, so that we can find the ones that start with a prefix
+        self.vocabulary = []
+        # trigram -> tokens that contain it. There are a lot fewer distinct words than there are notes, so indexing
+        # the words rather than the notes keeps this small and cheap to update
+        self.trigrams = {}
+        # note id -> (group name, position in the group, note, title, (text, format, anchors), token -> weighted count,
+        # weighted length). The format and anchors (see markup.NOTE_FORMATS) change what the text means.
+        self.notes = {}
+        # the sum of the weighted lengths of the notes, for working out the average
+        self.total_length = 0
+        # goes up every time the index changes, so that anything worked out from it can tell when it's out of date
+        self.generation = 0
+        # group name -> the generation when it last changed, for groups that have been changed, removed or renamed
+        self.changes = {}
+        # group name -> ids of the notes in it, in order. Notes that have been moved to another group since are None
+        self.groups = {}
+
+    def add_tokens(self, note_id, tokens):
+        for token in tokens:
+            ids = self.postings.get(token)
+            if ids is None:
+                ids = self.postings[token] = set()
+                bisect.insort(self.vocabulary, token)
+                for trigram in get_trigrams(token):
+                    self.trigrams.setdefault(trigram, set()).add(token)
+            ids.add(note_id)
+
+    def remove_tokens(self, note_id, tokens):
+        for token in tokens:
+            ids = self.postings[token]
+            ids.discard(note_id)
+            if len(ids) == 0:
+                del self.postings[token]
+                del self.vocabulary[bisect.bisect_left(self.vocabulary, token)]
+                for trigram in get_trigrams(token):
+                    tokens_with_trigram = self.trigrams[trigram]
+                    tokens_with_trigram.discard(token)
+                    if len(tokens_with_trigram) == 0:
+                        del self.trigrams[trigram]
+
+    def remove_note(self, note_id):
+        entry = self.notes.pop(note_id)
+        self.remove_tokens(note_id, entry[5])
+        self.total_length -= entry[6]
+
+    def update_group(self, group_name, notes):
+        self.generation += 1
+        self.changes[group_name] = self.generation
+        ids = []
+        for position, note in enumerate(notes):
+            note_id = note['id']
+            title = note.get('title') or ''
+            text = note.get('text') or ''
+            contents = (text, note.get('format'), note.get('anchors'))
+
+            entry = self.notes.get(note_id)
+            if entry is not None and entry[0] != group_name and entry[0] in self.groups:
+                old_ids = self.groups[entry[0]]
+                if entry[1] < len(old_ids) and old_ids[entry[1]] == note_id:
+                    old_ids[entry[1]] = None
+
+            if entry is not None and entry[3] == title and entry[4] == contents:
+                (counts, length) = entry[5:7]
+            else:
+                if entry is not None:
+                    self.remove_tokens(note_id, entry[5])
+                    self.total_length -= entry[6]
+
+                # notes from the file handler come with their plain text and normalized title already worked out
+                plain_text = note.get('plain_text')
+                if plain_text is None:
+                    plain_text = get_note_plain_text(note)
+                normalized_title = note.get('normalized_title')
+                if normalized_title is not None:
+                    title_tokens = token_pattern.findall(normalized_title)
+                else:
+                    title_tokens = tokenize(title)
+
+                counts = {}
+                for token in tokenize(plain_text):
+                    counts[token] = counts.get(token, 0) + 1
+                length = sum(counts.values())
+                for token in title_tokens:
+                    counts[token] = counts.get(token, 0) + TITLE_WEIGHT
+                length += TITLE_WEIGHT * len(title_tokens)
+
+                self.add_tokens(note_id, counts)
+                self.total_length += length
+
+            self.notes[note_id] = (group_name, position, note, title, contents, counts, length)
+            ids.append(note_id)
+
+        # A note that was dragged to another group may already have been added there, in which case it belongs to
+        # that group now and has to be left alone
+        current_ids = set(ids)
+        for note_id in self.groups.get(group_name, []):
+            entry = self.notes.get(note_id)
+            if entry is not None and entry[0] == group_name and note_id not in current_ids:
+                self.remove_note(note_id)
+
+        self.groups[group_name] = ids
+
+    def remove_group(self, group_name):
+        self.generation += 1
+        self.changes[group_name] = self.generation
+        for note_id in self.groups.pop(group_name, []):
+            entry = self.notes.get(note_id)
+            if entry is not None and entry[0] == group_name:
+                self.remove_note(note_id)
+
+    def rename_group(self, old_name, new_name):
+        self.remove_group(new_name)
+        self.generation += 1
+        self.changes[old_name] = self.changes[new_name] = self.generation
+
+        ids = self.groups.pop(old_name, [])
+        for note_id in ids:
+            entry = self.notes.get(note_id)
+            if entry is not None and entry[0] == old_name:
+                self.notes[note_id] = (new_name,) + entry[1:]
+
+        self.groups[new_name] = ids
+
+    def find_prefix(self, prefix):
+        # every token that starts with `prefix`
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        end = start
+        while end < len(self.vocabulary) and self.vocabulary[end].startswith(prefix):
+            end += 1
+
+        return self.vocabulary[start:end]
+
+    def find_similar(self, word):
+        # token -> similarity, for every token that has at least FUZZY_THRESHOLD of the trigrams in `word`
+        if len(word) < FUZZY_MIN_LENGTH:
+            return {}
+
+        trigrams = get_trigrams(word)
+        counts = {}
+        for trigram in trigrams:
+            for token in self.trigrams.get(trigram, ()):
+                counts[token] = counts.get(token, 0) + 1
+
+        minimum = FUZZY_THRESHOLD * len(trigrams)
+        return {token: count / len(trigrams) for token, count in counts.items() if count >= minimum}
+
+    def get_idf(self, token):
+        # rarer words say more about which notes are relevant
+        count = len(self.postings[token])
+        return math.log(1 + (len(self.notes) - count + 0.5) / (count + 0.5))
+
+    def get_weights(self, word):
+        # token -> weight, for every token that matches `word`. Tokens that start with it count fully, and the rest
+        # count as much as they are similar
+        similarities = self.find_similar(word)
+        for token in self.find_prefix(word):
+            similarities[token] = 1.0
+
+        return {token: similarity * self.get_idf(token) for token, similarity in similarities.items()}
+
+    def get_average_length(self):
+        return self.total_length / max(len(self.notes), 1)
+
+    # The weights can come from another index, which only this one's notes are then scored against (see
+    # search_pool.py), so the methods below have to cope with tokens that aren't in this index.
+
+    def find_matches(self, weights, candidates=None):
+        # the ids of the notes (in `candidates`, if given) that contain one of the tokens in `weights`
+        if candidates is None:
+            return set().union(*[self.postings.get(token, ()) for token in weights])
+
+        matches = set()
+        for token in weights:
+            matches |= candidates.intersection(self.postings.get(token, ()))
+
+        return matches
+
+    def score_word(self, word, weights, average_length, candidates=None, limit=None):
+        # Returns note id -> BM25 score for `word`, for the notes that contain one of the tokens in `weights` (and are in
+        # `candidates`, if given). Each note is scored on the heaviest token it contains.
+        #
+        # If `limit` is given, only that many notes are needed, so we can stop once no note that hasn't been scored yet
+        # could beat the ones we have. With a word or two, that saves scoring most of the notes.
+        length_base = BM25_K1 * (1 - BM25_B)
+        length_scale = BM25_K1 * BM25_B / average_length
+        notes = self.notes
+
+        # A letter or two matches so many different words that how often they appear in a note says very little, so
+        # until more has been typed, notes are only ranked by the weight of the word they matched. That way they can
+        # be scored a whole token at a time.
+        use_counts = len(word) >= FUZZY_MIN_LENGTH
+
+        scores = {}
+        best = []
+        for token in sorted(weights, key=weights.get, reverse=True):
+            # nothing can score more than this with the tokens that are left
+            weight = weights[token] * (BM25_K1 + 1) if use_counts else weights[token]
+            if limit is not None and len(best) == limit and best[0] > weight:
+                break
+
+            ids = self.postings.get(token)
+            if ids is None:
+                continue
+            if candidates is not None:
+                ids = ids.intersection(candidates)
+
+            # the set operations pick out the notes that haven't been scored yet without going through the ones that
+            # have, which matters when a word matches most of the notes
+            new_ids = ids.difference(scores)
+            if not use_counts:
+                scores.update(dict.fromkeys(new_ids, weight))
+                if limit is not None:
+                    # the weights only go down, so there's never anything better to replace
+                    for index in range(min(len(new_ids), limit - len(best))):
+                        heapq.heappush(best, weight)
+                continue
+
+            for note_id in new_ids:
+                entry = notes[note_id]
+                count = entry[5][token]
+                score = scores[note_id] = weight * count / (count + length_base + length_scale * entry[6])
+
+                if limit is not None:
+                    if len(best) < limit:
+                        heapq.heappush(best, score)
+                    elif score > best[0]:
+                        heapq.heapreplace(best, score)
+
+        return scores
+
+    def get_score_limit(self, group_names, limit):
+        # score_word() stops once it has `limit` notes, which only works if they can all be in the results, so the
+        # limit is only passed on if every group in the index is in `group_names`
+        if limit is not None and self.groups.keys() <= set(group_names):
+            return limit
+
+        return None
+
+    def get_word_weights(self, words):
+        # [(word, weights)] for each of `words` in order, leaving out repeats, or None if one of them matches nothing
+        word_weights = []
+        for word in dict.fromkeys(words):
+            weights = self.get_weights(word)
+            if len(weights) == 0:
+                return None
+            word_weights.append((word, weights))
+
+        return word_weights
+
+    def score_words(self, words, limit=None, candidates=None):
+        # Returns note id -> the sum of the BM25 scores for each of `words`, for the notes (in `candidates`, if given)
+        # that match all of them. `limit` is as for score_word(), and only helps with a single word.
+        word_weights = self.get_word_weights(words)
+        if not word_weights:
+            return {}
+
+        return self.score_weights(word_weights, self.get_average_length(), limit, candidates)
+
+    def score_weights(self, word_weights, average_length, limit=None, candidates=None):
+        # score_words(), with the weights from get_word_weights()
+        if len(word_weights) == 1:
+            return self.score_word(word_weights[0][0], word_weights[0][1], average_length, candidates, limit)
+
+        # Notes have to match every word, so only the notes that do need to be scored. Starting from the word with the
+        # fewest matches keeps the candidates down to a handful after the first word or two.
+        for (word, weights) in sorted(word_weights, key=lambda item: sum(len(self.postings.get(token, ()))
+                                                                        for token in item[1])):
+            candidates = self.find_matches(weights, candidates)
+            if len(candidates) == 0:
+                return {}
+
+        # the scores are added up in the order of the words, so that they come out exactly the same whether or not some
+        # of them were passed to search() as `known`
+        totals = dict.fromkeys(candidates, 0)
+        for (word, weights) in word_weights:
+            for note_id, score in self.score_word(word, weights, average_length, candidates).items():
+                totals[note_id] += score
+
+        return totals
+
+    def search(self, query, group_names, limit=None, known=None):
+        # Yields (group name, note) for every note that matches all the words in `query` (or the best `limit` of them),
+        # best matches first. Notes that match equally well are in the order of `group_names`, and then their order
+        # within the group.
+        #
+        # `known` can be (words, scores) with the scores from score_words() for the first few words of the query, in
+        # which case the rest are only looked up among the notes that match those. While a query is being typed,
+        # everything but the last word stays the same from one keystroke to the next. The index can change after the
+        # scores were worked out, so the ones for notes that have been removed since are dropped.
+        words = tokenize(query)
+        if known is not None and words[:len(known[0])] == known[0]:
+            known_words = known[0]
+            known_scores = {note_id: score for note_id, score in known[1].items() if note_id in self.notes}
+            words = [word for word in words if word not in known_words]
+            if len(known_scores) == 0 or len(words) == 0:
+                totals = dict(known_scores)
+            else:
+                totals = self.score_words(words, candidates=set(known_scores))
+                for note_id in totals:
+                    totals[note_id] += known_scores[note_id]
+        else:
+            totals = self.score_words(words, self.get_score_limit(group_names, limit))
+
+        if len(totals) == 0:
+            return
+
+        for note_id in self.rank(totals, group_names, limit):
+            entry = self.notes[note_id]
+            yield (entry[0], entry[2])
+
+    def rank(self, totals, group_names, limit=None):
+        # Returns the ids in `totals` (note id -> score), or the best `limit` of them, best first. Notes with the same
+        # score are in the order of `group_names`, and then their order within the group.
+        #
+        # Searching for a letter or two can match most of the notes, in which case it's quicker to go through every
+        # note in order and pick out the matches than to sort the matches. Sorting just the ids, and having search()
+        # hand the results out one at a time rather than building a list of them, avoids creating lots of objects that
+        # the garbage collector would then have to go through along with the whole index.
+        ordered = []
+        if len(totals) * 8 > len(self.notes):
+            for group_name in group_names:
+                ordered += [note_id for note_id in self.groups.get(group_name, []) if note_id in totals]
+        else:
+            positions = {}
+            for note_id in totals:
+                entry = self.notes[note_id]
+                positions.setdefault(entry[0], []).append(entry[1])
+
+            for group_name in group_names:
+                if group_name in positions:
+                    ids = self.groups[group_name]
+                    ordered += [ids[position] for position in sorted(positions[group_name])]
+
+        # both of these are stable, so notes with the same score stay in order
+        if limit is not None:
+            ordered = heapq.nlargest(limit, ordered, key=totals.get)
+        else:
+            ordered.sort(key=totals.get, reverse=True)
+
+        return ordered
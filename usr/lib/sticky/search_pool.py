@@ -0,0 +1,158 @@
+#!/usr/bin/python3
+
+import concurrent.futures
+import multiprocessing
+import os
+
+from search import SearchIndex, tokenize
+
+# there's a worker process per core, up to this many
+SEARCH_POOL_MAX_WORKERS = 4
+
+# what the worker processes are started with (see search_worker.py)
+WORKER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'search_worker.py')
+
+# the fields the workers need to index a note
+INDEXED_FIELDS = ['id', 'title', 'text', 'format', 'anchors', 'plain_text', 'normalized_title']
+
+# the index in a worker process, which only has the notes that were sent to that worker
+shard = None
+
+def init_shard():
+    global shard
+    shard = SearchIndex()
+
+def sync_shard(updates, removed_groups):
+    # `updates` is [(group name, ids, id -> note)], with the notes that are new or have changed since they were last
+    # sent. The rest are already in the shard, and are all looked up before anything changes, as a note that was moved
+    # to another group might otherwise be removed with the first group before the second one is updated.
+    notes_lists = []
+    for (group_name, ids, notes) in updates:
+        notes_lists.append((group_name, [notes[note_id] if note_id in notes else shard.notes[note_id][2]
+                                         for note_id in ids]))
+
+    for (group_name, notes) in notes_lists:
+        shard.update_group(group_name, notes)
+
+    for group_name in removed_groups:
+        shard.remove_group(group_name)
+
+def search_shard(word_weights, average_length, group_names, limit):
+    totals = shard.score_weights(word_weights, average_length, shard.get_score_limit(group_names, limit))
+    return [(note_id, totals[note_id]) for note_id in shard.rank(totals, group_names, limit)]
+
+# Spreads searches across worker processes, for when there are so many notes that scoring them takes too long for one
+# core. The notes are split between the workers by id, and each worker keeps an index of its share, which sync() brings
+# up to date with an index in this process. That index still works out the weights of the words in the query, so that
+# every worker scores its notes the same way, and then picks the best results from all of the workers (see merge()).
+class SearchPool(object):
+    def __init__(self, workers=None):
+        if workers is None:
+            workers = min(os.cpu_count() or 1, SEARCH_POOL_MAX_WORKERS)
+
+        # The workers are started from scratch rather than forked, as forking a process that's running GTK (and other
+        # threads) isn't safe. Each one gets a single process, so that everything sent to it is handled in order. They
+        # run search_worker.py rather than the interpreter itself, so that they don't load the rest of the application.
+        context = multiprocessing.get_context('spawn')
+        context.set_executable(WORKER_PATH)
+        self.executors = [concurrent.futures.ProcessPoolExecutor(1, context, init_shard) for index in range(workers)]
+
+        # the syncs that the workers haven't finished yet, which starts with them starting up
+        self.pending = [executor.submit(init_shard) for executor in self.executors]
+
+        # the index the workers were last synced with, and its generation at the time
+        self.index = None
+        self.generation = 0
+        # note id -> (title, (text, format, anchors)) as last sent to its worker
+        self.sent = {}
+
+    def get_worker(self, note_id):
+        return hash(note_id) % len(self.executors)
+
+    def sync(self, index):
+        # sends the workers whatever has changed in `index` since the last sync
+        if index is not self.index:
+            for executor in self.executors:
+                self.pending.append(executor.submit(init_shard))
+            self.index = index
+            self.generation = 0
+            self.sent = {}
+
+        updates = [[] for executor in self.executors]
+        removed_groups = []
+        for (group_name, generation) in index.changes.items():
+            if generation <= self.generation:
+                continue
+
+            ids = index.groups.get(group_name)
+            if ids is None:
+                removed_groups.append(group_name)
+                continue
+
+            worker_ids = [[] for executor in self.executors]
+            worker_notes = [{} for executor in self.executors]
+            for note_id in ids:
+                if note_id is None:
+                    continue
+
+                entry = index.notes[note_id]
+                worker = self.get_worker(note_id)
+                worker_ids[worker].append(note_id)
+                if self.sent.get(note_id) != (entry[3], entry[4]):
+                    worker_notes[worker][note_id] = {field: entry[2][field] for field in INDEXED_FIELDS
+                                                     if field in entry[2]}
+                    self.sent[note_id] = (entry[3], entry[4])
+
+            for worker in range(len(self.executors)):
+                updates[worker].append((group_name, worker_ids[worker], worker_notes[worker]))
+
+        if len(removed_groups) > 0 or any(updates):
+            # the workers drop the notes that were removed on their own, so we only need to forget them here
+            for note_id in [note_id for note_id in self.sent if note_id not in index.notes]:
+                del self.sent[note_id]
+
+            for (executor, worker_updates) in zip(self.executors, updates):
+                self.pending.append(executor.submit(sync_shard, worker_updates, removed_groups))
+
+        self.generation = index.generation
+        self.pending = [future for future in self.pending if not future.done()]
+
+    def is_ready(self):
+        # whether the workers have caught up with the last sync, so that searching won't have to wait for them
+        self.pending = [future for future in self.pending if not future.done()]
+        return len(self.pending) == 0
+
+    def search(self, index, query, group_names, limit):
+        # Starts searching for `query` in the workers, after syncing them with `index`. Returns the futures to pass to
+        # merge() once they're done.
+        self.sync(index)
+
+        word_weights = index.get_word_weights(tokenize(query))
+        if not word_weights:
+            return []
+
+        average_length = index.get_average_length()
+        return [executor.submit(search_shard, word_weights, average_length, group_names, limit)
+                for executor in self.executors]
+
+    def merge(self, index, futures, group_names, limit):
+        # Yields (group name, note) for the best `limit` results from all of the workers, in the same order as
+        # SearchIndex.search(). Raises whatever went wrong if a worker failed.
+        group_positions = {group_name: position for (position, group_name) in enumerate(group_names)}
+
+        results = []
+        for future in futures:
+            for (note_id, score) in future.result():
+                # the note may have been removed while the workers were searching
+                entry = index.notes.get(note_id)
+                if entry is not None:
+                    results.append((-score, group_positions.get(entry[0], len(group_positions)), entry[1], note_id))
+
+        results.sort()
+        for result in results[:limit]:
+            entry = index.notes[result[3]]
+            yield (entry[0], entry[2])
+
+    def shutdown(self):
+        for executor in self.executors:
+            executor.shutdown(wait=False, cancel_futures=True)
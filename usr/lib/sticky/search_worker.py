@@ -0,0 +1,20 @@
+#!/usr/bin/python3
+
+# The search worker processes (see search_pool.py) are started with this script in place of the Python interpreter.
+# multiprocessing runs the interpreter as `python3 [options] -c PROGRAM --multiprocessing-fork`, and the program it
+# gives starts by importing the main script of the process that started it, which for us is the whole application,
+# GTK and all. The workers only need what they're sent, which they import as it's unpickled, so this runs the same
+# program without that step.
+
+import multiprocessing.spawn
+import sys
+
+if __name__ == '__main__':
+    multiprocessing.spawn._fixup_main_from_path = lambda main_path: None
+    multiprocessing.spawn._fixup_main_from_name = lambda main_name: None
+
+    # anything before -c is an interpreter option, which we're already running with
+    index = sys.argv.index('-c')
+    program = sys.argv[index + 1]
+    sys.argv = ['-c'] + sys.argv[index + 2:]
+    exec(compile(program, '<string>', 'exec'), {'__name__': '__main__'})
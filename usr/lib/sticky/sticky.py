@@ -17,6 +17,8 @@ from note_buffer import NoteBuffer
 from manager import NotesManager
 from common import FileHandler, HoverBox, prompt, confirm
 from util import gnote_to_internal_format
+from storage import generate_note_id
+from markup import NOTE_TEXT_FIELDS, get_note_fields, get_note_format, get_note_markup
 
 import gettext
 gettext.install("sticky", "/usr/share/locale", names="ngettext")
@@ -125,12 +127,16 @@ class Note(Gtk.Window):
         self.changed_timer_id = 0
         self.invalid_cache = False
 
+        self.id = info.get('id') or generate_note_id()
         self.x = info.get('x', 0)
         self.y = info.get('y', 0)
         self.height = info.get('height', self.app.settings.get_uint('default-height'))
         self.width = info.get('width', self.app.settings.get_uint('default-width'))
         title = info.get('title', '')
-        self.cached_text = info.get('text', '')
+        # the fields the note's contents were last saved in, along with their format, so that they're only worked out
+        # again when the text or the format changes
+        self.cached_fields = (get_note_format(info), {field: info[field] for field in NOTE_TEXT_FIELDS if field in info})
+        self.cached_fields[1].setdefault('text', '')
         self.color = info.get('color', self.app.settings.get_string('default-color'))
 
         super(Note, self).__init__(
@@ -235,7 +241,7 @@ class Note(Gtk.Window):
         self.add(scroll)
         scroll.add(self.view)
 
-        self.buffer.set_from_internal_markup(self.cached_text)
+        self.buffer.set_from_markup(get_note_markup(info))
         self.changed_id = self.buffer.connect('content-changed', self.queue_update, True)
 
         self.app.settings.connect('changed::font', self.set_font)
@@ -387,20 +393,27 @@ class Note(Gtk.Window):
         self.emit('update')
 
     def get_info(self):
-        if self.invalid_cache:
-            self.cached_text = self.buffer.get_internal_markup()
+        # Notes are saved in whichever format is set at the time. Either way, the buffer only reads and serializes the
+        # lines that have changed since the last time.
+        note_format = self.app.settings.get_string('note-format')
+        if self.invalid_cache or self.cached_fields[0] != note_format:
+            if note_format == 'markup':
+                self.cached_fields = (note_format, {'text': self.buffer.get_internal_markup()})
+            else:
+                self.cached_fields = (note_format, get_note_fields(self.buffer.get_markup(), note_format))
             self.invalid_cache = False
 
         (width, height) = self.get_size()
         info = {
+            'id': self.id,
             'x': self.x,
             'y': self.y,
             'height': self.height,
             'width': self.width,
             'color': self.color,
-            'title': self.title.get_text(),
-            'text': self.cached_text
+            'title': self.title.get_text()
         }
+        info.update(self.cached_fields[1])
 
         return info
 
@@ -1103,11 +1116,13 @@ class Application(Gtk.Application):
             self.generate_note(note_info)
 
     def reload_notes_from_file(self):
+        # notes.json is imported if something has written it since the notes were last saved (see common.CONFIG_PATH)
         self.file_handler.load_notes()
         self.load_notes();
 
     def duplicate_note(self, new_note):
         new_note_info = new_note.get_info()
+        del new_note_info['id']
         new_note_info['x'] += 50
         new_note_info['y'] += 50
 
@@ -0,0 +1,1017 @@
+#!/usr/bin/python3
+
+import gzip
+import hashlib
+import io
+import json
+import lzma
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import uuid
+
+from search import normalize, tokenize
+from markup import (NOTE_TEXT_FIELDS, OBJECT_REPLACEMENT_CHAR, SPANS_FORMAT_VERSION, get_note_fields, get_note_format,
+                    get_note_markup, get_note_plain_text)
+
+# fsync policies, from most to least durable:
+#   'full' - fsync the new file before it replaces the old one, then fsync the directory so the rename itself survives a
+#            crash
+#   'file' - only fsync the new file. After a crash we may end up with the old file, but never a partial one
+#   'none' - leave it to the kernel. This is the fastest, but a crash shortly after saving could leave an empty file
+FSYNC_POLICIES = ['full', 'file', 'none']
+
+# mkstemp() always creates files that are only readable by the owner, so we need the umask to give new files the
+# permissions they would have had if we had just opened them for writing
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+temp_file_name = re.compile(r"\A\..+\.[a-z0-9_]+\.tmp$")
+
+INDEX_VERSION = 1
+
+# once the journal grows past this many bytes, it is folded back into the group files
+JOURNAL_COMPACT_SIZE = 1024 * 1024
+
+MANIFEST_VERSION = 1
+
+# a backup pack is only rewritten without the notes that no backup uses any more once they make up this much of it, so
+# that the first pack, which has every note from the first backup, isn't rewritten every time an old note drops out
+PACK_GARBAGE_RATIO = 0.5
+
+# compression formats for backups and exports. Files are read with open_file(), which works out the format from the
+# first few bytes rather than the file name, so changing the format never breaks older files.
+COMPRESSION_FORMATS = ['none', 'gzip', 'xz']
+
+# Measured on ~15MB of notes: gzip 6 is within 2% of the size of gzip 9 in half the time (6.5x smaller, 0.7s vs 1.3s),
+# and xz only beats it at its default preset, which is ~20x slower. Either is fine on the backup thread.
+GZIP_LEVEL = 6
+XZ_PRESET = 6
+
+GZIP_MAGIC = b'\x1f\x8b'
+XZ_MAGIC = b'\xfd7zXZ\x00'
+
+# how much of a file is read at a time when streaming it with JsonStreamReader
+READ_CHUNK_SIZE = 64 * 1024
+
+# the types of the note fields we know about. Notes can have other fields as well, which are left alone
+NOTE_FIELD_TYPES = {
+    'id': str,
+    'title': str,
+    'text': str,
+    'color': str,
+    'x': (int, float),
+    'y': (int, float),
+    'width': (int, float),
+    'height': (int, float),
+    'plain_text': str,
+    'word_count': int,
+    'normalized_title': str,
+    'format': int,
+    'spans': list,
+    'anchors': list
+}
+
+# Fields that are worked out from a note's title and text and saved along with it, so that search (or anything else
+# that wants the text without the markup) doesn't have to parse every note again after a restart. See
+# add_derived_fields().
+DERIVED_FIELDS = ['plain_text', 'word_count', 'normalized_title']
+
+STORAGE_BACKENDS = ['files', 'sqlite']
+
+SQLITE_SYNCHRONOUS = {
+    'full': 'FULL',
+    'file': 'NORMAL',
+    'none': 'OFF'
+}
+
+def create_store(backend, directory):
+    if backend == 'sqlite':
+        return SqliteStore(directory)
+
+    return ShardedStore(directory)
+
+def generate_note_id():
+    return uuid.uuid4().hex
+
+def write_file_atomic(path, write_func, fsync_policy='full', compression='none'):
+    # The data is written to a temporary file in the same directory and then renamed over the destination, so that the
+    # destination always contains either the old or the new contents, never a partially written file.
+    # `write_func` is called with a file object open for writing text, which is compressed as it is written if
+    # `compression` is one of COMPRESSION_FORMATS other than 'none'.
+    directory = os.path.dirname(os.path.abspath(path))
+    (fd, temp_path) = tempfile.mkstemp(dir=directory, prefix='.%s.' % os.path.basename(path), suffix='.tmp')
+
+    try:
+        try:
+            mode = os.stat(path).st_mode & 0o7777
+        except FileNotFoundError:
+            mode = 0o666 & ~UMASK
+        os.chmod(temp_path, mode)
+
+        with os.fdopen(fd, 'wb') as raw_file:
+            stream = open_compressor(raw_file, compression)
+            file = io.TextIOWrapper(stream, encoding='utf-8')
+            write_func(file)
+            file.detach()
+
+            if stream is not raw_file:
+                # this writes out the end of the compressed stream, but leaves raw_file open
+                stream.close()
+
+            raw_file.flush()
+
+            if fsync_policy != 'none':
+                os.fsync(raw_file.fileno())
+
+        os.replace(temp_path, path)
+    except:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+
+        raise
+
+    if fsync_policy == 'full':
+        fsync_directory(directory)
+
+def open_compressor(raw_file, compression):
+    if compression == 'gzip':
+        # leaving the time out of the header means that the same notes always compress to the same bytes
+        return gzip.GzipFile(fileobj=raw_file, mode='wb', compresslevel=GZIP_LEVEL, mtime=0)
+    elif compression == 'xz':
+        return lzma.LZMAFile(raw_file, 'wb', preset=XZ_PRESET)
+
+    return raw_file
+
+def get_compression(path):
+    with open(path, 'rb') as file:
+        magic = file.read(len(XZ_MAGIC))
+
+    if magic.startswith(GZIP_MAGIC):
+        return 'gzip'
+    elif magic == XZ_MAGIC:
+        return 'xz'
+
+    return 'none'
+
+def open_file(path):
+    # opens a file for reading text, decompressing it as it is read if it was compressed
+    compression = get_compression(path)
+    if compression == 'gzip':
+        return gzip.open(path, 'rt', encoding='utf-8')
+    elif compression == 'xz':
+        return lzma.open(path, 'rt', encoding='utf-8')
+
+    return open(path, 'r', encoding='utf-8')
+
+def validate_note(note):
+    if not isinstance(note, dict):
+        raise ValueError('expected a note, found %s' % type(note).__name__)
+
+    for (field, value) in note.items():
+        field_type = NOTE_FIELD_TYPES.get(field)
+        if field_type is not None and value is not None and (not isinstance(value, field_type) or value is True or
+                                                             value is False):
+            raise ValueError('invalid value for note %s: %r' % (field, value))
+
+    if note.get('format') is not None:
+        validate_spans(note)
+
+def is_offset(value):
+    return isinstance(value, int) and value is not True and value is not False and value >= 0
+
+def validate_spans(note):
+    # checks that the formatting of a note in the spans format fits its text, as the buffer can't load it otherwise
+    if note['format'] != SPANS_FORMAT_VERSION:
+        raise ValueError('unsupported note format %s' % note['format'])
+
+    text = note.get('text') or ''
+    for span in note.get('spans') or []:
+        if (not isinstance(span, list) or len(span) != 3 or not is_offset(span[0]) or not is_offset(span[1]) or
+                span[0] > span[1] or span[1] > len(text) or not isinstance(span[2], str)):
+            raise ValueError('invalid span in note: %r' % (span,))
+
+    previous_offset = -1
+    for anchor in note.get('anchors') or []:
+        if (not isinstance(anchor, list) or len(anchor) != 3 or not is_offset(anchor[0]) or
+                anchor[0] <= previous_offset or anchor[0] >= len(text) or text[anchor[0]] != OBJECT_REPLACEMENT_CHAR or
+                anchor[1] not in ('check', 'bullet') or not isinstance(anchor[2], bool)):
+            raise ValueError('invalid anchor in note: %r' % (anchor,))
+
+        previous_offset = anchor[0]
+
+def get_derived_key(note):
+    # everything the derived fields are worked out from (the spans don't change the plain text, but the anchors do)
+    return (note.get('title') or '', note.get('text') or '', note.get('format'), note.get('anchors'))
+
+def add_derived_fields(notes, previous_notes=None):
+    # Adds the derived fields to any of `notes` that are missing them, and returns whether any had to be worked out.
+    # They're taken from the note with the same id in `previous_notes` if its title and text are the same, as notes
+    # that have just been edited come in as new dicts. Notes that already have them are trusted: everything that
+    # changes a note's title or text builds a new note without them, and files from elsewhere go through
+    # remove_derived_fields() first.
+    previous = {}
+    for note in previous_notes or []:
+        if 'plain_text' in note:
+            previous[note.get('id')] = note
+
+    added = False
+    for note in notes:
+        if 'plain_text' in note:
+            continue
+
+        title = note.get('title') or ''
+
+        old_note = previous.get(note.get('id'))
+        if old_note is not None and get_derived_key(old_note) == get_derived_key(note):
+            for field in DERIVED_FIELDS:
+                note[field] = old_note[field]
+            continue
+
+        note['plain_text'] = get_note_plain_text(note)
+        note['word_count'] = len(tokenize(note['plain_text']))
+        note['normalized_title'] = normalize(title)
+        added = True
+
+    return added
+
+def remove_derived_fields(notes):
+    for note in notes:
+        for field in DERIVED_FIELDS:
+            note.pop(field, None)
+
+def convert_notes(notes, note_format):
+    # Converts any of `notes` that are saved in another format to `note_format` (see markup.NOTE_FORMATS), and returns
+    # whether there were any. Their derived fields are removed, to be added again by add_derived_fields(). Notes whose
+    # markup can't be read are left as they are, as validate_note() doesn't go as far as checking it.
+    converted = False
+    for note in notes:
+        if get_note_format(note) == note_format:
+            continue
+
+        try:
+            fields = get_note_fields(get_note_markup(note), note_format)
+        except (ValueError, IndexError) as e:
+            print('unable to convert note %s: %s' % (note.get('id'), e))
+            continue
+
+        for field in NOTE_TEXT_FIELDS + DERIVED_FIELDS:
+            note.pop(field, None)
+        note.update(fields)
+        converted = True
+
+    return converted
+
+def read_notes_lists(file):
+    # Reads notes in the format of notes.json and exports ({group name: [notes]}) from a file object, a note at a time
+    # rather than reading the whole file into memory first, and checks that they're valid along the way. Raises
+    # ValueError if the file isn't in the right format.
+    reader = JsonStreamReader(file)
+    notes_lists = {}
+
+    for group_name in reader.iter_object():
+        notes = []
+        for index in reader.iter_array():
+            note = reader.read_value()
+            validate_note(note)
+            notes.append(note)
+
+        notes_lists[group_name] = notes
+
+    reader.expect_end()
+
+    return notes_lists
+
+# A minimal incremental JSON reader. The caller walks through the containers it expects with iter_object() and
+# iter_array(), and reads anything it wants in one piece with read_value(), so that only the value being read needs to
+# be in memory, rather than the whole file.
+class JsonStreamReader(object):
+    whitespace = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, file, chunk_size=READ_CHUNK_SIZE):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, size):
+        # drop whatever has been read already, so that the buffer doesn't grow with the file
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+
+        data = self.file.read(size)
+        if data == '':
+            self.eof = True
+        self.buffer += data
+
+    def peek(self):
+        # returns the next character that isn't whitespace, without consuming it, or '' at the end of the file
+        while True:
+            self.pos = self.whitespace.match(self.buffer, self.pos).end()
+
+            if self.pos < len(self.buffer) or self.eof:
+                return self.buffer[self.pos:self.pos + 1]
+
+            self.fill(self.chunk_size)
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError('expected %r, found %r' % (char, found))
+
+        self.pos += 1
+
+    def expect_end(self):
+        found = self.peek()
+        if found != '':
+            raise ValueError('unexpected %r after the end of the data' % found)
+
+    def read_value(self):
+        self.peek()
+
+        while True:
+            try:
+                (value, end) = self.decoder.raw_decode(self.buffer, self.pos)
+
+                # a number at the end of the buffer might continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+
+            # the value doesn't fit in what we have so far. Reading at least as much again as we already have keeps the
+            # number of attempts down for values that are much larger than a chunk
+            self.fill(max(self.chunk_size, len(self.buffer) - self.pos))
+
+    def iter_items(self, start, end):
+        self.expect(start)
+
+        if self.peek() == end:
+            self.pos += 1
+            return
+
+        while True:
+            yield
+
+            found = self.peek()
+            self.pos += 1
+            if found == end:
+                return
+            elif found != ',':
+                raise ValueError('expected %r or %r, found %r' % (',', end, found))
+
+    def iter_object(self):
+        # yields each key in an object. The caller must read the value that goes with it before asking for the next one
+        for item in self.iter_items('{', '}'):
+            key = self.read_value()
+            if not isinstance(key, str):
+                raise ValueError('expected a key, found %r' % key)
+
+            self.expect(':')
+            yield key
+
+    def iter_array(self):
+        # yields the index of each item in an array. The caller must read the item before asking for the next one
+        index = 0
+        for item in self.iter_items('[', ']'):
+            yield index
+            index += 1
+
+def fsync_directory(directory):
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+
+    try:
+        os.fsync(fd)
+    except OSError:
+        # not all file systems support syncing a directory
+        pass
+    finally:
+        os.close(fd)
+
+def remove_stale_temp_files(directory):
+    # temporary files are only left behind if we crashed (or were killed) in the middle of a save
+    if not os.path.isdir(directory):
+        return
+
+    for file in os.listdir(directory):
+        if temp_file_name.search(file):
+            try:
+                os.remove(os.path.join(directory, file))
+            except OSError:
+                pass
+
+# Stores each group in its own file under groups/, along with a small index that maps the group names (in order) to
+# their files. Group files are never shared, and are always written before the index that references them, so an
+# interrupted save can at worst leave an orphaned group file behind, which is cleaned up the next time the index is
+# loaded.
+#
+# Rather than rewriting the group files every time, saves append just the notes that changed to a journal. Once the
+# journal grows past JOURNAL_COMPACT_SIZE, the groups it touched are written out and the journal is cleared. Each line in
+# the journal is one of:
+#   {"groups": [names]}             the complete, ordered list of groups
+#   {"group": name, "put": note}    a note that was added to or changed in a group
+#   {"group": name, "order": [ids]} the notes in a group, in order. Notes that aren't listed were removed
+# Replaying a record more than once has no further effect, so it doesn't matter if we crash part way through compacting.
+class ShardedStore(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self.index_path = os.path.join(directory, 'index.json')
+        self.journal_path = os.path.join(directory, 'journal.jsonl')
+        self.groups_dir = os.path.join(directory, 'groups')
+
+        # group name -> file name (relative to groups_dir), as currently written to the index
+        self.group_files = {}
+        # the current group names, including any changes in the journal
+        self.group_names = []
+        # group name -> (note ids in order, note id -> note), as currently saved, for each group that has been loaded
+        self.groups = {}
+        # journal records that haven't been applied to the group they belong to yet, by group name
+        self.pending_records = {}
+        # groups that have been changed in the journal since their group file was written
+        self.journaled_groups = set()
+        self.journal_size = 0
+        self.needs_compaction = False
+        self.lock = threading.Lock()
+
+    def exists(self):
+        return os.path.exists(self.index_path)
+
+    def get_modified_time(self):
+        # when the store was last written to. Group files are renamed into place, which updates the directory's time
+        return max(os.path.getmtime(path) for path in (self.index_path, self.journal_path, self.groups_dir)
+                   if os.path.exists(path))
+
+    def delete(self):
+        with self.lock:
+            for path in (self.index_path, self.journal_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            shutil.rmtree(self.groups_dir, ignore_errors=True)
+
+            self.group_files = {}
+            self.group_names = []
+            self.groups = {}
+            self.pending_records = {}
+            self.journaled_groups = set()
+            self.journal_size = 0
+
+    def load_index(self):
+        with self.lock:
+            with open(self.index_path, 'r') as file:
+                index = json.loads(file.read())
+
+            if index.get('version', 0) > INDEX_VERSION:
+                raise ValueError('unsupported index version %s' % index['version'])
+
+            self.group_files = {}
+            for entry in index['groups']:
+                self.group_files[entry['name']] = entry['file']
+
+            if os.path.isdir(self.groups_dir):
+                referenced = set(self.group_files.values())
+                for file in os.listdir(self.groups_dir):
+                    if file not in referenced:
+                        os.remove(os.path.join(self.groups_dir, file))
+
+            self.group_names = list(self.group_files.keys())
+            self.groups = {}
+            self.pending_records = {}
+            self.journaled_groups = set()
+            self.read_journal()
+
+            return list(self.group_names)
+
+    def read_journal(self):
+        self.journal_size = 0
+        self.needs_compaction = False
+
+        if not os.path.exists(self.journal_path):
+            return
+
+        with open(self.journal_path, 'r') as file:
+            for line in file:
+                self.journal_size += len(line)
+
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last save before a crash may have only been partially written. Anything written after it
+                    # would be unreadable, so we make sure the next save clears the journal
+                    self.needs_compaction = True
+                    continue
+
+                if 'groups' in record:
+                    # groups that aren't in the list have been removed, so they start from scratch if they come back
+                    for group_name in self.group_names:
+                        if group_name not in record['groups']:
+                            self.pending_records.setdefault(group_name, []).append(None)
+                    self.group_names = record['groups']
+                else:
+                    self.pending_records.setdefault(record['group'], []).append(record)
+
+        self.journaled_groups = set(self.pending_records.keys())
+
+    def load_group(self, group_name):
+        with self.lock:
+            # the journal records for a group are used up the first time it's read (see read_group()), and backups can
+            # read groups that are then loaded again later
+            if group_name in self.groups:
+                (ids, notes_by_id) = self.groups[group_name]
+                return [notes_by_id[note_id].copy() for note_id in ids]
+
+            return self.read_group(group_name)
+
+    def read_group(self, group_name):
+        if group_name in self.group_files:
+            with open(os.path.join(self.groups_dir, self.group_files[group_name]), 'r') as file:
+                notes = json.loads(file.read())
+        else:
+            notes = []
+
+        ids = [note['id'] for note in notes]
+        notes_by_id = {note['id']: note for note in notes}
+
+        for record in self.pending_records.pop(group_name, []):
+            if record is None:
+                ids = []
+                notes_by_id = {}
+            elif 'put' in record:
+                note = record['put']
+                if note['id'] not in notes_by_id:
+                    ids.append(note['id'])
+                notes_by_id[note['id']] = note
+            else:
+                ids = record['order']
+
+        notes_by_id = {note_id: notes_by_id[note_id] for note_id in ids}
+        self.groups[group_name] = (ids, notes_by_id)
+
+        return [notes_by_id[note_id].copy() for note_id in ids]
+
+    def load(self):
+        notes_lists = {}
+        for group_name in self.load_index():
+            notes_lists[group_name] = self.load_group(group_name)
+
+        return notes_lists
+
+    def save(self, changed_groups, group_names, fsync_policy='full'):
+        # `changed_groups` maps the names of the groups that need to be saved to their note lists, `group_names` is the
+        # complete (ordered) list of groups that should exist once the save is complete. The notes in `changed_groups`
+        # are kept to compare against next time, so they must not be modified afterwards
+        with self.lock:
+            # What we know about what's saved is only updated for good once the save has been written. If writing it
+            # fails, this is put back, so that the next save still sees everything that changed, and as the journal may
+            # have been left with part of a record in it, the next save rewrites it from scratch.
+            previous_state = (dict(self.groups), dict(self.pending_records), set(self.journaled_groups),
+                              list(self.group_names))
+            try:
+                self.write_changes(changed_groups, group_names, fsync_policy)
+            except Exception:
+                (self.groups, self.pending_records, self.journaled_groups, self.group_names) = previous_state
+                self.needs_compaction = True
+                raise
+
+    def write_changes(self, changed_groups, group_names, fsync_policy):
+        records = []
+
+        if group_names != self.group_names:
+            records.append({'groups': group_names})
+
+            for group_name in set(self.group_names) - set(group_names):
+                self.groups.pop(group_name, None)
+                self.pending_records.pop(group_name, None)
+                self.journaled_groups.discard(group_name)
+
+            self.group_names = list(group_names)
+
+        for group_name, notes in changed_groups.items():
+            if group_name not in group_names:
+                continue
+
+            (old_ids, old_notes) = self.groups.get(group_name, (None, {}))
+            ids = [note['id'] for note in notes]
+            notes_by_id = {note['id']: note for note in notes}
+
+            group_records = []
+            for note in notes:
+                if old_notes.get(note['id']) != note:
+                    group_records.append({'group': group_name, 'put': note})
+
+            if ids != old_ids:
+                group_records.append({'group': group_name, 'order': ids})
+
+            # the journal is only ever replayed on top of the group file, so the group's entire contents are now
+            # known and we can forget about whatever was in the journal for it
+            self.pending_records.pop(group_name, None)
+            self.groups[group_name] = (ids, notes_by_id)
+
+            if len(group_records) > 0:
+                self.journaled_groups.add(group_name)
+                records += group_records
+
+        if len(records) == 0 and not self.needs_compaction:
+            return
+
+        data = ''.join(json.dumps(record) + '\n' for record in records)
+
+        if self.needs_compaction or not self.exists() or self.journal_size + len(data) > JOURNAL_COMPACT_SIZE:
+            self.compact(fsync_policy)
+        else:
+            self.append_to_journal(data, fsync_policy)
+
+    def append_to_journal(self, data, fsync_policy):
+        is_new = not os.path.exists(self.journal_path)
+
+        with open(self.journal_path, 'a') as file:
+            file.write(data)
+            file.flush()
+
+            if fsync_policy != 'none':
+                os.fsync(file.fileno())
+
+        if is_new and fsync_policy == 'full':
+            fsync_directory(self.directory)
+
+        self.journal_size += len(data)
+
+    def compact(self, fsync_policy):
+        if not os.path.exists(self.groups_dir):
+            os.makedirs(self.groups_dir)
+
+        new_files = {}
+        for group_name in self.group_names:
+            if group_name in self.group_files:
+                new_files[group_name] = self.group_files[group_name]
+            else:
+                new_files[group_name] = generate_note_id() + '.json'
+                self.journaled_groups.add(group_name)
+
+        for group_name in self.journaled_groups:
+            if group_name not in new_files:
+                continue
+
+            if group_name not in self.groups:
+                self.read_group(group_name)
+
+            (ids, notes_by_id) = self.groups[group_name]
+            notes = [notes_by_id[note_id] for note_id in ids]
+            path = os.path.join(self.groups_dir, new_files[group_name])
+            write_file_atomic(path, lambda file: file.write(json.dumps(notes, indent=4)), fsync_policy)
+
+        # dicts compare equal regardless of order, but the order of the groups matters to us
+        if list(new_files.items()) != list(self.group_files.items()) or not self.exists():
+            index = {
+                'version': INDEX_VERSION,
+                'groups': [{'name': name, 'file': file} for name, file in new_files.items()]
+            }
+            write_file_atomic(self.index_path, lambda file: file.write(json.dumps(index, indent=4)), fsync_policy)
+
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+
+        removed_files = set(self.group_files.values()) - set(new_files.values())
+        self.group_files = new_files
+        self.journaled_groups = set()
+        self.pending_records = {}
+        self.journal_size = 0
+        self.needs_compaction = False
+
+        for file in removed_files:
+            try:
+                os.remove(os.path.join(self.groups_dir, file))
+            except FileNotFoundError:
+                pass
+
+# Stores one row per note in an SQLite database, keyed by the note's id. The store remembers what it last wrote for each
+# note, so saving a group that has had one note edited only updates that note's row.
+class SqliteStore(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, 'notes.db')
+        self.connection = None
+
+        # note id -> (group name, position, note), as currently stored in the database. Comparing the notes themselves is
+        # a lot cheaper than serializing every note in the group to see what changed
+        self.rows = {}
+        # group name -> ids of the notes in that group, for every group whose rows are all in self.rows
+        self.group_ids = {}
+        self.group_names = []
+        self.lock = threading.Lock()
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def get_modified_time(self):
+        # when the store was last written to, which may only be in the write-ahead log so far
+        return max(os.path.getmtime(path) for path in (self.path, self.path + '-wal') if os.path.exists(path))
+
+    def delete(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+            for path in (self.path, self.path + '-wal', self.path + '-shm'):
+                if os.path.exists(path):
+                    os.remove(path)
+
+            self.rows = {}
+            self.group_ids = {}
+            self.group_names = []
+
+    def connect(self):
+        if self.connection is not None:
+            return
+
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        # saves happen on a worker thread, but never at the same time as anything else, as everything holds self.lock
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS groups (name TEXT PRIMARY KEY, position INTEGER NOT NULL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS notes (id TEXT PRIMARY KEY, group_name TEXT NOT NULL, '
+                                'position INTEGER NOT NULL, data TEXT NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS notes_by_group ON notes (group_name, position)')
+        self.connection.commit()
+
+    def load_index(self):
+        with self.lock:
+            self.connect()
+
+            cursor = self.connection.execute('SELECT name FROM groups ORDER BY position')
+            self.group_names = [row[0] for row in cursor]
+
+            return list(self.group_names)
+
+    def load_group(self, group_name):
+        with self.lock:
+            self.connect()
+
+            notes = []
+            ids = set()
+            cursor = self.connection.execute('SELECT id, position, data FROM notes WHERE group_name = ? ORDER BY position',
+                                             (group_name,))
+            for (note_id, position, data) in cursor:
+                note = json.loads(data)
+                self.rows[note_id] = (group_name, position, note)
+                ids.add(note_id)
+                notes.append(note.copy())
+
+            self.group_ids[group_name] = ids
+
+            return notes
+
+    def load(self):
+        notes_lists = {}
+        for group_name in self.load_index():
+            notes_lists[group_name] = self.load_group(group_name)
+
+        return notes_lists
+
+    def save(self, changed_groups, group_names, fsync_policy='full'):
+        # the notes in `changed_groups` are kept to compare against next time, so they must not be modified afterwards
+        with self.lock:
+            self.connect()
+            self.connection.execute('PRAGMA synchronous=%s' % SQLITE_SYNCHRONOUS[fsync_policy])
+
+            new_rows = {}
+            new_group_ids = {}
+            for group_name, notes in changed_groups.items():
+                if group_name not in group_names:
+                    continue
+
+                ids = new_group_ids[group_name] = set()
+                for position, note in enumerate(notes):
+                    new_rows[note['id']] = (group_name, position, note)
+                    ids.add(note['id'])
+
+            removed_groups = set(self.group_names) - set(group_names)
+
+            with self.connection:
+                # we can't tell which notes were removed from a group we haven't read, so just start it from scratch
+                for group_name in new_group_ids:
+                    if group_name not in self.group_ids:
+                        self.connection.execute('DELETE FROM notes WHERE group_name = ?', (group_name,))
+
+                for note_id, (group_name, position, note) in new_rows.items():
+                    if self.rows.get(note_id) != (group_name, position, note):
+                        self.connection.execute('INSERT OR REPLACE INTO notes (id, group_name, position, data) '
+                                                'VALUES (?, ?, ?, ?)', (note_id, group_name, position, json.dumps(note)))
+
+                # notes that were in one of the groups we were given, but aren't in any of them anymore, were removed
+                removed_ids = set()
+                for group_name in new_group_ids:
+                    removed_ids |= self.group_ids.get(group_name, set())
+                removed_ids -= new_rows.keys()
+
+                for note_id in removed_ids:
+                    self.connection.execute('DELETE FROM notes WHERE id = ?', (note_id,))
+
+                for group_name in removed_groups:
+                    self.connection.execute('DELETE FROM notes WHERE group_name = ?', (group_name,))
+
+                if group_names != self.group_names:
+                    self.connection.execute('DELETE FROM groups')
+                    self.connection.executemany('INSERT INTO groups (name, position) VALUES (?, ?)',
+                                                [(name, position) for position, name in enumerate(group_names)])
+
+            for note_id in removed_ids:
+                del self.rows[note_id]
+
+            for group_name in removed_groups:
+                for note_id in self.group_ids.pop(group_name, set()):
+                    if note_id not in new_rows:
+                        self.rows.pop(note_id, None)
+
+            # notes that moved into one of the changed groups need to be taken out of the group they came from
+            for group_name, ids in self.group_ids.items():
+                if group_name not in new_group_ids:
+                    ids -= new_rows.keys()
+
+            self.rows.update(new_rows)
+            self.group_ids.update(new_group_ids)
+            self.group_names = list(group_names)
+
+# Backups are stored as manifests that list the notes in each group by the hash of their contents. The notes themselves
+# are stored in packs under backup-blobs/, and each backup only adds a pack with the notes that weren't in the previous
+# backup, so notes that haven't changed don't take up any more space. Storing a pack per backup rather than a file per
+# note avoids wasting a file system block on every note. Manifest format:
+#   {"version": 1, "groups": [{"name": name, "notes": [hashes]}], "packs": [names of the packs the notes are in]}
+# backup-blobs/packs.index lists the hashes in each pack ({pack name: [hashes]}), so that collect_garbage() can tell
+# which packs have notes in them that are no longer needed without reading them. It's only ever a guide: a pack that
+# isn't in it is read to find out, and one that it says has too much in it is just rewritten.
+class BackupStore(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self.blobs_dir = os.path.join(directory, 'backup-blobs')
+        self.pack_index_path = os.path.join(self.blobs_dir, 'packs.index')
+
+    def get_pack_path(self, pack_name):
+        return os.path.join(self.blobs_dir, pack_name + '.json')
+
+    def read_pack_index(self):
+        try:
+            with open(self.pack_index_path, 'r') as file:
+                pack_index = json.loads(file.read())
+        except (OSError, ValueError):
+            return {}
+
+        if not isinstance(pack_index, dict):
+            return {}
+
+        return pack_index
+
+    def write_pack_index(self, pack_index, fsync_policy):
+        write_file_atomic(self.pack_index_path, lambda file: file.write(json.dumps(pack_index)), fsync_policy)
+
+    def read_pack_hashes(self, pack_path):
+        # the hashes in a pack, without keeping the notes in memory
+        hashes = []
+        with open_file(pack_path) as file:
+            reader = JsonStreamReader(file)
+            for note_hash in reader.iter_object():
+                reader.read_value()
+                hashes.append(note_hash)
+
+        return hashes
+
+    def save(self, path, notes_lists, previous_manifest_path=None, fsync_policy='full', compression='none'):
+        # anything that was in the previous backup can be reused
+        packs = []
+        existing_hashes = set()
+        if previous_manifest_path is not None:
+            previous_manifest = self.read_manifest(previous_manifest_path)
+            packs = previous_manifest['packs']
+            for group in previous_manifest['groups']:
+                existing_hashes.update(group['notes'])
+
+        new_pack = {}
+        groups = []
+        for group_name, notes in notes_lists.items():
+            hashes = []
+            for note in notes:
+                data = json.dumps(note, sort_keys=True)
+                note_hash = hashlib.blake2b(data.encode('utf-8'), digest_size=16).hexdigest()
+
+                if note_hash not in existing_hashes:
+                    new_pack[note_hash] = note
+
+                hashes.append(note_hash)
+
+            groups.append({'name': group_name, 'notes': hashes})
+
+        if len(new_pack) > 0:
+            if not os.path.exists(self.blobs_dir):
+                os.makedirs(self.blobs_dir)
+
+            pack_name = generate_note_id()
+            write_file_atomic(self.get_pack_path(pack_name), lambda file: file.write(json.dumps(new_pack)), fsync_policy,
+                              compression)
+            packs = packs + [pack_name]
+
+            pack_index = self.read_pack_index()
+            pack_index[pack_name] = list(new_pack.keys())
+            self.write_pack_index(pack_index, fsync_policy)
+
+        manifest = {'version': MANIFEST_VERSION, 'groups': groups, 'packs': packs}
+        write_file_atomic(path, lambda file: file.write(json.dumps(manifest)), fsync_policy, compression)
+
+    def read_manifest(self, path):
+        with open_file(path) as file:
+            manifest = json.loads(file.read())
+
+        if manifest.get('version', 0) > MANIFEST_VERSION:
+            raise ValueError('unsupported backup version %s' % manifest['version'])
+
+        return manifest
+
+    def load(self, path):
+        manifest = self.read_manifest(path)
+
+        # packs that no longer have any notes we need are removed by collect_garbage(), so it's fine if they're missing
+        notes_by_hash = {}
+        for pack_name in manifest['packs']:
+            pack_path = self.get_pack_path(pack_name)
+            if os.path.exists(pack_path):
+                with open_file(pack_path) as file:
+                    # the first pack has every note that was in the first backup, so it can be quite large
+                    reader = JsonStreamReader(file)
+                    for note_hash in reader.iter_object():
+                        note = reader.read_value()
+                        validate_note(note)
+                        notes_by_hash[note_hash] = note
+
+        notes_lists = {}
+        for group in manifest['groups']:
+            if not isinstance(group.get('name'), str):
+                raise ValueError('invalid group name in backup: %r' % group.get('name'))
+
+            notes_lists[group['name']] = [notes_by_hash[note_hash].copy() for note_hash in group['notes']]
+
+        return notes_lists
+
+    def collect_garbage(self, manifest_paths, fsync_policy='full'):
+        # removes any notes that aren't used by one of the given manifests, along with packs that end up empty. Packs
+        # with only a few such notes are left alone (see PACK_GARBAGE_RATIO)
+        if not os.path.isdir(self.blobs_dir):
+            return
+
+        referenced = set()
+        for path in manifest_paths:
+            for group in self.read_manifest(path)['groups']:
+                referenced.update(group['notes'])
+
+        pack_index = self.read_pack_index()
+        new_pack_index = {}
+        for file in os.listdir(self.blobs_dir):
+            # a pack that was being written when we crashed (see remove_stale_temp_files()) isn't used by any backup
+            if temp_file_name.search(file) or not file.endswith('.json'):
+                continue
+
+            pack_name = file[:-len('.json')]
+            pack_path = os.path.join(self.blobs_dir, file)
+            hashes = pack_index.get(pack_name)
+            if not isinstance(hashes, list):
+                hashes = self.read_pack_hashes(pack_path)
+
+            unreferenced = len([note_hash for note_hash in hashes if note_hash not in referenced])
+            if unreferenced == len(hashes):
+                os.remove(pack_path)
+                continue
+            elif unreferenced < PACK_GARBAGE_RATIO * len(hashes):
+                new_pack_index[pack_name] = hashes
+                continue
+
+            with open_file(pack_path) as pack_file:
+                pack = json.loads(pack_file.read())
+
+            kept = {note_hash: note for note_hash, note in pack.items() if note_hash in referenced}
+            if len(kept) == 0:
+                os.remove(pack_path)
+                continue
+            elif len(kept) < len(pack):
+                # keep the pack in whatever format it was written in
+                write_file_atomic(pack_path, lambda file: file.write(json.dumps(kept)), fsync_policy,
+                                  get_compression(pack_path))
+
+            new_pack_index[pack_name] = list(kept.keys())
+
+        if new_pack_index != pack_index:
+            self.write_pack_index(new_pack_index, fsync_policy)
+
+    def delete(self):
+        shutil.rmtree(self.blobs_dir, ignore_errors=True)
@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+
+import collections
+import hashlib
+import os
+import re
+import tempfile
+
+import cairo
+
+# how many bytes of thumbnails are kept in memory, and on disk if that's turned on
+THUMBNAIL_MEMORY_CACHE_SIZE = 32 * 1024 * 1024
+THUMBNAIL_DISK_CACHE_SIZE = 64 * 1024 * 1024
+
+def get_thumbnail_key(*parts):
+    # Thumbnails are looked up by a digest of everything that affects how they look: the note's text and color, the
+    # font, and so on. Changing any of them just means the old thumbnail isn't used again, until it's evicted.
+    digest = hashlib.sha1()
+    for part in parts:
+        # each part is prefixed with its length, so that moving text from one part to the next changes the key
+        data = str(part).encode('utf-8', 'surrogatepass')
+        digest.update(b'%d:' % len(data))
+        digest.update(data)
+
+    return digest.hexdigest()
+
+def get_note_prefix(note_id):
+    # Thumbnails are saved with a prefix for the note they belong to, so that the ones for notes that no longer exist
+    # (or older versions of notes that do) can be found and removed. The id is hashed, as notes that were imported can
+    # have anything as their id.
+    return hashlib.sha1(str(note_id).encode('utf-8', 'surrogatepass')).hexdigest()[:16]
+
+# <note prefix>-<key>.png. Anything else in the directory was left behind by a crash or an older version
+thumbnail_file_name = re.compile(r"\A([0-9a-f]{16})-[0-9a-f]{40}\.png$")
+
+# Rendered previews for the manager, as cairo image surfaces. The most recently used are kept in memory, and if
+# `directory` is given, they're also saved there as PNGs so that they don't have to be rendered again after a restart.
+# Both are limited in size, and the least recently used thumbnails are dropped first. Only the latest thumbnail of each
+# note is kept on disk, and remove_other_notes() removes the ones for notes that have been deleted.
+class ThumbnailCache(object):
+    def __init__(self, directory=None, memory_size=THUMBNAIL_MEMORY_CACHE_SIZE, disk_size=THUMBNAIL_DISK_CACHE_SIZE):
+        # key -> surface, least recently used first
+        self.surfaces = collections.OrderedDict()
+        self.size = 0
+        self.memory_size = memory_size
+
+        self.directory = directory
+        self.disk_size = disk_size
+        self.disk_usage = 0
+        # note prefix -> (path, size) of the note's thumbnail on disk
+        self.disk_files = {}
+        if self.directory is not None:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                self.prune_disk()
+            except OSError as e:
+                print('Thumbnails will not be saved: %s' % e)
+                self.directory = None
+
+    def get_path(self, note_id, key):
+        return os.path.join(self.directory, '%s-%s.png' % (get_note_prefix(note_id), key))
+
+    def get(self, note_id, key, scale=1):
+        # Returns the thumbnail for `key` (a thumbnail of the note with the id `note_id`), or None if there isn't one.
+        # Thumbnails loaded from disk are scaled by `scale`, which should be the scale they were rendered at (it's part
+        # of the key).
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.surfaces.move_to_end(key)
+            return surface
+
+        if self.directory is None:
+            return None
+
+        path = self.get_path(note_id, key)
+        try:
+            surface = cairo.ImageSurface.create_from_png(path)
+            # the modification time is what decides which thumbnails are evicted from the disk
+            os.utime(path)
+        except (OSError, cairo.Error):
+            return None
+
+        surface.set_device_scale(scale, scale)
+        self.add_to_memory(key, surface)
+
+        return surface
+
+    def add(self, note_id, key, surface):
+        self.add_to_memory(key, surface)
+
+        if self.directory is None:
+            return
+
+        # thumbnails show what's in the notes, so they get the same permissions as the notes themselves (mkstemp()
+        # only lets the owner read them)
+        prefix = get_note_prefix(note_id)
+        path = self.get_path(note_id, key)
+        temp_path = None
+        try:
+            (fd, temp_path) = tempfile.mkstemp(dir=self.directory, prefix='.' + key, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as file:
+                surface.write_to_png(file)
+                size = file.tell()
+            os.replace(temp_path, path)
+        except (OSError, cairo.Error) as e:
+            print('Unable to save thumbnail: %s' % e)
+            if temp_path is not None and os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+
+        # the note's previous thumbnail shows what it used to say, so it's removed now rather than left to be evicted
+        if prefix in self.disk_files:
+            if self.disk_files[prefix][0] == path:
+                self.disk_usage -= self.disk_files.pop(prefix)[1]
+            else:
+                try:
+                    self.remove_note(prefix)
+                except OSError as e:
+                    print('Unable to remove thumbnail: %s' % e)
+
+        self.disk_files[prefix] = (path, size)
+        self.disk_usage += size
+        if self.disk_usage > self.disk_size:
+            try:
+                self.prune_disk()
+            except OSError as e:
+                print('Unable to remove old thumbnails: %s' % e)
+
+    def add_to_memory(self, key, surface):
+        if key in self.surfaces:
+            self.size -= self.get_surface_size(self.surfaces.pop(key))
+
+        self.surfaces[key] = surface
+        self.size += self.get_surface_size(surface)
+        while self.size > self.memory_size and len(self.surfaces) > 1:
+            (old_key, old_surface) = self.surfaces.popitem(last=False)
+            self.size -= self.get_surface_size(old_surface)
+
+    def get_surface_size(self, surface):
+        return surface.get_stride() * surface.get_height()
+
+    def prune_disk(self):
+        # works out how much space the thumbnails take up, and removes the least recently used ones (along with any
+        # temporary files left behind by a crash, and all but the latest thumbnail of each note) until they're down to
+        # three quarters of the limit
+        files = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                match = thumbnail_file_name.search(entry.name)
+                if match is None:
+                    os.remove(entry.path)
+                    continue
+
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path, match.group(1)))
+
+        # newest first, so that the thumbnail that's kept for each note is the latest one
+        files.sort(reverse=True)
+        self.disk_files = {}
+        self.disk_usage = 0
+        for (mtime, size, path, prefix) in files:
+            if prefix in self.disk_files:
+                os.remove(path)
+            else:
+                self.disk_files[prefix] = (path, size)
+                self.disk_usage += size
+
+        if self.disk_usage <= self.disk_size:
+            return
+
+        for (mtime, size, path, prefix) in reversed(files):
+            if self.disk_usage <= self.disk_size * 3 // 4:
+                break
+
+            if self.disk_files.get(prefix) == (path, size):
+                self.remove_note(prefix)
+
+    def remove_other_notes(self, note_ids):
+        # removes the thumbnails on disk for any notes other than the ones with the ids in `note_ids`, so that deleted
+        # notes don't stay readable as images
+        if self.directory is None:
+            return
+
+        prefixes = set(get_note_prefix(note_id) for note_id in note_ids)
+        for prefix in [prefix for prefix in self.disk_files if prefix not in prefixes]:
+            try:
+                self.remove_note(prefix)
+            except OSError as e:
+                print('Unable to remove thumbnail: %s' % e)
+
+    def remove_note(self, prefix):
+        (path, size) = self.disk_files.pop(prefix)
+        self.disk_usage -= size
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
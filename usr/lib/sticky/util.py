@@ -3,6 +3,8 @@
 import re
 import xml.etree.ElementTree as etree
 
+from markup import escape_text, format_tag, get_plain_text
+
 ip_number = r"(?:\d{1,2}|1\d{2}|2[0-4]\d|25[0-5])"
 ip_address = r"(?:(?:" + ip_number + ".){3}" + ip_number + ")"
 domain = r"(?:(?:[a-z\u00a1-\uffff0-9]-?)*[a-z\u00a1-\uffff0-9]+)(?:\.(?:[a-z\u00a1-\uffff0-9]-?)*[a-z\u00a1-\uffff0-9]+)*(?:\.(?:[a-z\u00a1-\uffff]{2,}))"
@@ -43,13 +45,13 @@ def gnote_to_internal_format(file_path):
 
         tag_name = element.tag.split('}')[1]
         if tag_name in GNOTE_TO_INTERNAL_MAP:
-            internal_tag = '#tag:%s:' % GNOTE_TO_INTERNAL_MAP[tag_name]
+            internal_tag = format_tag(GNOTE_TO_INTERNAL_MAP[tag_name])
             text += internal_tag
         else:
             internal_tag = ''
 
         if element.text:
-            text += element.text.replace('#', '##')
+            text += escape_text(element.text)
 
         for child in element:
             text += process_element(child)
@@ -57,7 +59,7 @@ def gnote_to_internal_format(file_path):
         text += internal_tag
 
         if element.tail:
-            text += element.tail.replace('#', '##')
+            text += escape_text(element.tail)
 
         return text
 
@@ -81,23 +83,4 @@ def gnote_to_internal_format(file_path):
     return category, info, is_template
 
 def clean_text(text):
-    current_index = 0
-    new_text = ''
-    while True:
-        next_index = text.find('#', current_index)
-        new_text += text[current_index:next_index]
-
-        if next_index == -1:
-            return new_text.lower()
-
-        if text[next_index:next_index+2] == '##':
-            new_text += '#'
-            current_index = next_index + 2
-        elif text[next_index:next_index+6] == '#check':
-            current_index = next_index + 8
-        elif text[next_index:next_index+7] == '#bullet':
-            current_index = next_index + 8
-        elif text[next_index:next_index+4] == '#tag':
-            current_index = text.find(':', next_index+6) + 1
-        else:
-            current_index += 1
+    return get_plain_text(text).lower()